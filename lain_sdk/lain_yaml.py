@@ -1,22 +1,85 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import time
 import re
+import json
+import hashlib
+import threading
 import collections
 import os.path as p
-from functools import partial
+from functools import partial, wraps
 import tempfile
 
 from .yaml.util import load_template
 from .yaml.conf import DOCKER_APP_ROOT, PRIVATE_REGISTRY, user_config
 from .yaml.parser import LainConf
 import mydocker
+from .phases import (run_phases, report_phases, dependent_phases,
+                     DEFAULT_PHASE_WORKERS)
 from .util import (error, warn, info, mkdir_p, rm, file_parent_dir,
-                   meta_version)
+                   meta_version, run_concurrently, LazyDict)
 from subprocess import call
 
 DOMAIN_KEY = user_config.domain_key
+# auto, multistage, stream or legacy
+RELEASE_ENGINE = os.environ.get('LAIN_RELEASE_ENGINE', 'auto')
+GLOB_PATTERN = re.compile(r'[*?\[]')
+# 内容寻址的 prepare image 放在同一个 repo 里，不同的 app 可以共用
+PREPARE_REPOSITORY = 'lain-prepare'
+# prepare 脚本里的单词，用来找脚本读的 context 文件
+SCRIPT_WORD_SEPARATOR = re.compile(r'''[\s;&|<>()'"`=]+''')
+
+class PrepareLookups(object):
+    """
+    Results of looking up prepare images and their tags, kept for one
+    LainYaml or shared by the apps of one AppsBuilder; cleared after a
+    prepare image is built
+    """
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, lookup):
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+        value = lookup()
+        with self._lock:
+            self._results[key] = value
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+def memoized_phase(phase):
+    """
+    Reuse the successful result of a phase built earlier in this session
+    for the same context and meta_version, as long as its image exists.
+    Pass force=True to rebuild; rebuilding a phase drops the results of
+    the phases depending on it.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            force = kwargs.pop('force', False)
+            self._prepare_act()
+            key = (phase, self.ctx, self.repo_meta_version())
+            cached = None if force else self.phase_results.get(key)
+            if cached is not None and mydocker.exist(cached[1]):
+                info('reusing {} image {}'.format(phase, cached[1]))
+                return cached
+            self.invalidate_phases(phase)
+            result = func(self, *args, **kwargs)
+            if result[0]:
+                self.phase_results[key] = result
+            return result
+        return wrapper
+    return decorator
 
 
 class LainYaml(object):
@@ -27,14 +90,16 @@ class LainYaml(object):
     either pass in during __init__, or pass in through init_act(yaml_path)
     """
 
-    def __init__(self, lain_yaml_path=None, ignore_prepare=False):
+    def __init__(self, lain_yaml_path=None, ignore_prepare=False, prepare_lookups=None):
+        # 查找结果只在这个 app（或一起构建的一批 app）里共用，不会跟着进程一直留着
+        self.prepare_lookups = prepare_lookups if prepare_lookups is not None else PrepareLookups()
         self.act = False  # lazy initialization, if only need to parse, on need to init fields related to actions
         self.yaml_path = lain_yaml_path
         if self.yaml_path is None:
             return
         self.init_act(self.yaml_path, ignore_prepare=ignore_prepare)
 
-    # @param meta_yaml: loaded yaml string
+    # @param meta_yaml: yaml string, file object, mmap or bytes buffer
     def load(self, meta_yaml, meta_version=None):
         parser = LainConf()
         parser.load(meta_yaml, meta_version, None)
@@ -44,7 +109,8 @@ class LainYaml(object):
 
     def init_act(self, path, ignore_prepare=False):
         self.yaml_path = p.abspath(path)
-        self.load(open(self.yaml_path).read())
+        with open(self.yaml_path, 'rb') as f:
+            self.load(f)
         self._prepare_act(ignore_prepare=ignore_prepare)
 
     def _get_prepare_shared_image_names(self, remote=True):
@@ -59,9 +125,11 @@ class LainYaml(object):
         image_prefix = "{}/{}".format(registry, self.appname)
         if remote:
             # 预设就是 prepare image 存在 PRIVATE_REGISTRY
-            tags = mydocker.get_tag_list_in_registry(registry, self.appname)
+            tags = self.prepare_lookups.get(('registry tags', registry, self.appname),
+                                               partial(mydocker.get_tag_list_in_registry, registry, self.appname))
         else:
-            tags = mydocker.get_tag_list_in_docker_daemon(registry, self.appname)
+            tags = self.prepare_lookups.get(('daemon tags', registry, self.appname),
+                                               partial(mydocker.get_tag_list_in_docker_daemon, registry, self.appname))
         prepare_shared_images = {}
         VALID_TAG_PATERN = re.compile(r"^prepare-{}-(?P<timestamp>\d+)$".format(prepare_version))
         for tag in tags:
@@ -85,18 +153,111 @@ class LainYaml(object):
             image_prefix, prepare_version, timestamp
         )
 
+    def prepare_build_args(self):
+        return getattr(self.build.prepare, 'build_arg', None) or []
+
+    def prepare_digest(self):
+        """
+        :return: sha256 of everything the prepare image is built from: the
+                 base image id, prepare version, scripts, keep, build args
+                 and the prepare files; None when the base image can not
+                 be found
+        """
+        base = self.build.base
+        base_id = mydocker.image_id(base)
+        if base_id is None and mydocker.pull(base) == 0:
+            base_id = mydocker.image_id(base)
+        if base_id is None:
+            return None
+        prepare = self.build.prepare
+        # 只算 prepare 用到的文件，改了其他源码的 app 和别的 app 仍然可以共用
+        inputs = [base_id, self.workdir, prepare.version, prepare.script, prepare.keep,
+                  mydocker.resolve_build_args(self.prepare_build_args()),
+                  mydocker.files_digest(self.ctx, self.prepare_files())]
+        return hashlib.sha256(json.dumps(inputs)).hexdigest()
+
+    def prepare_files(self):
+        """
+        :return: the context files the prepare image depends on: the ones
+                 named in the scripts (like requirements.txt) and the ones
+                 under the keep paths; every other file is removed after
+                 the scripts run
+        """
+        prepare = self.build.prepare
+        named = set(p.normpath(w) for w in SCRIPT_WORD_SEPARATOR.split(' '.join(prepare.script)) if w)
+        keep = [k.strip('/') for k in prepare.keep if k.strip('/')]
+        patterns = mydocker.context_ignore_patterns(self.ctx, self.ignore)
+        files = []
+        for name, path in mydocker.walk_context(self.ctx, mydocker.DockerIgnore(patterns)):
+            if p.isdir(path) and not p.islink(path):
+                continue
+            if name in named or any(name == k or name.startswith(k + '/') for k in keep):
+                files.append(name)
+        return files
+
+    def gen_content_prepare_image_name(self, digest):
+        return "{}/{}:{}".format(PRIVATE_REGISTRY, PREPARE_REPOSITORY, digest)
+
+    def gen_updated_prepare_image_name(self, name):
+        """
+        :return: name of the image updating the content-addressed prepare
+                 image `name`, derived from its digest and the image id
+                 it is built from; None when that image is not local
+        """
+        parent_id = mydocker.image_id(name)
+        if parent_id is None:
+            return None
+        digest = name.rsplit(':', 1)[1]
+        return self.gen_content_prepare_image_name(
+            hashlib.sha256(json.dumps(['update', digest, parent_id])).hexdigest())
+
+    def is_content_prepare_image(self, name):
+        return name.startswith("{}/{}:".format(PRIVATE_REGISTRY, PREPARE_REPOSITORY))
+
+    def resolve_prepare_image(self, ignore_prepare=False):
+        """
+        :return: name of the prepare image, pulled when it is only in the
+                 registry; the image may have to be built
+        """
+        if ignore_prepare:
+            return self.gen_prepare_shared_image_name()
+        if PRIVATE_REGISTRY is None:
+            error("Please set private_docker_registry config first!")
+            error("Use 'lain config save-global private_docker_registry ${registry_domain}'")
+            exit(1)
+        digest = self.prepare_digest()
+        if digest is None:
+            # 找不到 base image 时没法算 digest，还是按 prepare version 找
+            warn("base image {} not found, looking up prepare image by version".format(self.build.base))
+            return self.ensure_proper_shared_image() or self.gen_prepare_shared_image_name()
+        name = self.gen_content_prepare_image_name(digest)
+        local, remote = run_concurrently(
+            lambda: self.prepare_lookups.get(('local', name), partial(mydocker.exist, name)),
+            lambda: self.prepare_lookups.get(('remote', name), partial(mydocker.exist_in_registry, name)))
+        if local:
+            info("found prepare image {} at local.".format(name))
+        elif remote:
+            info("found prepare image {} at remote.".format(name))
+            if mydocker.pull(name) != 0:
+                error("FAILED: docker pull {}".format(name))
+                raise Exception("remote prepare fetching failed.")
+        else:
+            warn("found no prepare image {} neither at local nor remote, rebuild ...".format(name))
+        return name
+
     def ensure_proper_shared_image(self):
         # 在 registry 以及本地寻找合适可用的 shared prepare
         # 如果找到则保证本地和 registry 里此 image 均可用
         # 上述行为成功后返回此 prepare image name
         # 两处都没有合适的 image name 则返回 None
-        remote_images = self._get_prepare_shared_image_names(True).items()
+        remote_images, local_images = [images.items() for images in run_concurrently(
+            partial(self._get_prepare_shared_image_names, True),
+            partial(self._get_prepare_shared_image_names, False))]
         if remote_images:
             remote_latest = remote_images[0]
         else:
             remote_latest = None
 
-        local_images = self._get_prepare_shared_image_names(False).items()
         if local_images:
             local_latest = local_images[0]
         else:
@@ -130,6 +291,7 @@ class LainYaml(object):
             warn("found no proper shared prepare image neither at local nor remote, rebuild ...")
             return None
 
+    @memoized_phase('prepare')
     def build_prepare(self):
         """
         :return: (True, image_name) or (False, None)
@@ -142,10 +304,13 @@ class LainYaml(object):
                 'workdir': self.workdir,
                 'copy_list': ['.'],
                 'scripts': self.build.prepare.script,
+                'build_args': [arg.split('=')[0] for arg in self.prepare_build_args()]
             }
-            name = self.img_builders['prepare'](context=self.ctx, params=params, build_args=[])
+            name = self.img_builders['prepare'](context=self.ctx, params=params,
+                                                build_args=self.prepare_build_args())
             if name is None:
                 return (False, None)
+            self.prepare_lookups.clear()
             if mydocker.push(self.img_names['prepare']) != 0:
                 warn("FAILED: docker push {}".format(self.img_names['prepare']))
             return (True, name)
@@ -165,10 +330,13 @@ class LainYaml(object):
                 'workdir': self.workdir,
                 'copy_list': ['.'],
                 'scripts': self.build.prepare.script,
+                'build_args': [arg.split('=')[0] for arg in self.prepare_build_args()]
             }
-            name = self.img_builders['prepare'](context=self.ctx, params=params, build_args=[])
+            name = self.img_builders['prepare'](context=self.ctx, params=params,
+                                                build_args=self.prepare_build_args())
             if name is None:
                 return (False, None)
+            self.prepare_lookups.clear()
             if mydocker.push(self.img_names['prepare']) != 0:
                 warn("FAILED: docker push {}".format(self.img_names['prepare']))
             return (True, name)
@@ -178,17 +346,31 @@ class LainYaml(object):
                 'workdir': self.workdir,
                 'copy_list': ['.'],
                 'scripts': self.build.prepare.script,
+                'build_args': [arg.split('=')[0] for arg in self.prepare_build_args()]
             }
+            # 内容寻址的 prepare image 是共用的，更新后的 image 不能再用原来的名字
+            content_addressed = self.is_content_prepare_image(self.img_names['prepare'])
+            if content_addressed:
+                name = self.gen_updated_prepare_image_name(self.img_names['prepare'])
+                if name is None:
+                    return (False, None)
+            else:
+                name = self.gen_prepare_shared_image_name()
             name = self.prepare_updater(
-                name=self.gen_prepare_shared_image_name(),
-                context=self.ctx, params=params, build_args=[])
+                name=name, context=self.ctx, params=params,
+                build_args=self.prepare_build_args(), use_cache=False)
             if name is None:
                 return (False, None)
+            self.prepare_lookups.clear()
+            self.invalidate_phases('prepare')
+            if content_addressed:
+                self.img_names['prepare'] = name
             if mydocker.push(name) != 0:
                 warn("FAILED: docker push {}".format(name))
 
             return (True, name)
 
+    @memoized_phase('build')
     def build_base(self, use_prepare=False):
         """
         :return: (True, image_name) or (False, None)
@@ -213,6 +395,7 @@ class LainYaml(object):
             return (False, None)
         return (True, name)
 
+    @memoized_phase('release')
     def build_release(self, use_prepare=False, use_build=False):
         """
         :return: (True, image_name) or (False, None)
@@ -240,6 +423,91 @@ class LainYaml(object):
             mydocker.tag(script_inter_name, self.img_names['release'])
             return (True, self.img_names['release'])
 
+        engine = self.release_engine()
+        if engine == 'multistage':
+            name = self.release_multistage(script_inter_name)
+        elif engine == 'stream':
+            try:
+                name = self.release_stream(script_inter_name)
+            except Exception as e:
+                warn('streaming release failed ({}), falling back to legacy'.format(e))
+                name = self.release_legacy(script_inter_name)
+        else:
+            name = self.release_legacy(script_inter_name)
+        if script_inter_name != self.img_names['build']:
+            mydocker.remove_image(script_inter_name)
+        if name is None:
+            return (False, None)
+        return (True, name)
+
+    def release_engine(self):
+        """
+        :return: 'multistage', 'stream' or 'legacy'; LAIN_RELEASE_ENGINE=auto
+                 picks multistage when the docker daemon supports COPY --from,
+                 stream otherwise, and legacy when release.copy has globs
+        """
+        if RELEASE_ENGINE not in ('auto', 'multistage', 'stream', 'legacy'):
+            raise Exception('invalid LAIN_RELEASE_ENGINE %s' % RELEASE_ENGINE)
+        if RELEASE_ENGINE == 'auto':
+            if mydocker.supports_multistage():
+                return 'multistage'
+            # 从 export 的 tar 流里只能按路径挑文件，不支持通配符
+            if any(GLOB_PATTERN.search(src) for src, _ in self.release_copy_list()):
+                return 'legacy'
+            return 'stream'
+        return RELEASE_ENGINE
+
+    def release_copy_list(self):
+        """
+        :return: [(src, dest)] of release.copy as absolute paths in the images
+        """
+        return [(p.join(DOCKER_APP_ROOT, x.get('src', x)), p.join(DOCKER_APP_ROOT, x.get('dest', x)))
+                for x in self.release.copy]
+
+    def release_multistage(self, source):
+        """
+        Build release from dest_base with COPY --from=source, the artifacts
+        never leave the docker daemon
+
+        :return: image name or None
+        """
+        params = {
+            'base': self.release.dest_base,
+            'source': source,
+            'workdir': self.workdir,
+            'copy_list': self.release_copy_list(),
+        }
+        # 不需要 context 里的文件，mydocker.build 会发送空的 context
+        return mydocker.build(self.img_names['release'], self.ctx, self.ignore,
+                              self.release_multistage_temp, params, [])
+
+    def release_stream(self, source):
+        """
+        Build release from dest_base with the release.copy sources streamed
+        from `docker export` of source straight into `docker build -`
+
+        :return: image name or None
+        """
+        copy_list = self.release_copy_list()
+        names = ['release/%d' % i for i in range(len(copy_list))]
+        params = {
+            'base': self.release.dest_base,
+            'workdir': self.workdir,
+            'copy_list': zip(names, [dest for _, dest in copy_list]),
+        }
+        source_id = mydocker.image_id(source)
+        digest = source_id and repr((source_id, copy_list))
+        return mydocker.build_from_stream(
+            self.img_names['release'], self.release_stream_temp, params,
+            partial(mydocker.export_paths, source, copy_list), digest)
+
+    def release_legacy(self, script_inter_name):
+        """
+        Tar the artifacts in an intermediate image, copy the tar to host and
+        build release from the extracted files
+
+        :return: image name or None
+        """
         copy_dest = '/lain/release'
 
         def to_dest(f):
@@ -262,10 +530,8 @@ class LainYaml(object):
         }
         inter_name = self.gen_name(phase='copy_inter')
         copy_inter_name = mydocker.build(inter_name, self.ctx, self.ignore, self.img_temps['build'], params, [])
-        if script_inter_name != self.img_names['build']:
-            mydocker.remove_image(script_inter_name)
         if copy_inter_name is None:
-            return (False, None)
+            return None
 
         try:
             host_release_tar = tempfile.NamedTemporaryFile(delete=False).name
@@ -290,17 +556,16 @@ class LainYaml(object):
             for f in delete:
                 if p.exists(f):
                     rm(f)
+            mydocker.remove_context_tars(untar)
+        return name
 
-        if name is None:
-            return (False, None)
-        return (True, name)
-
-    def build_test(self):
+    @memoized_phase('test')
+    def build_test(self, use_build=False):
         """
         :return: (True, image_name) or (False, None)
         """
         self._prepare_act()
-        if not self.build_base(use_prepare=True)[0]:
+        if (not use_build) and (not self.build_base(use_prepare=True)[0]):
             return (False, None)
 
         params = {
@@ -311,7 +576,7 @@ class LainYaml(object):
         }
         test_name = self.img_builders['test'](context=self.ctx, params=params, build_args=[])
         if test_name is None:
-            last_container_id = mydocker.get_latest_container_id()
+            last_container_id = mydocker.get_failed_container_id(params['base'], params['scripts'])
             if last_container_id != -1:
                 # for lain enter-test, tricky, ugly, but works!
                 mydocker.commit(last_container_id, self.img_names['test'])
@@ -323,12 +588,13 @@ class LainYaml(object):
             info("Tests Passed")
             return (True, test_name)
 
-    def build_publish(self):
+    @memoized_phase('publish')
+    def build_publish(self, use_build=False):
         """
         :return: (True, image_name) or (False, None)
         """
         self._prepare_act()
-        if not self.build_base(use_prepare=True)[0]:
+        if (not use_build) and (not self.build_base(use_prepare=True)[0]):
             return (False, None)
 
         params = {
@@ -337,9 +603,11 @@ class LainYaml(object):
             'copy_list': [],
             'scripts': self.publish.script
         }
-        publish_name = self.img_builders['publish'](context=self.ctx, params=params, build_args=[])
+        # publish 脚本要的是副作用，命中 build cache 也要执行
+        publish_name = self.img_builders['publish'](context=self.ctx, params=params, build_args=[],
+                                                    use_cache=False)
         if publish_name is None:
-            last_container_id = mydocker.get_latest_container_id()
+            last_container_id = mydocker.get_failed_container_id(params['base'], params['scripts'])
             if last_container_id != -1:
                 mydocker.commit(last_container_id, self.img_names['publish'])
 
@@ -350,6 +618,7 @@ class LainYaml(object):
             info("Publish Success")
             return (True, publish_name)
 
+    @memoized_phase('meta')
     def build_meta(self):
         """
         :return: (True, image_name) or (False, None)
@@ -363,6 +632,41 @@ class LainYaml(object):
             return (False, None)
         return (True, name)
 
+    def build_phases(self, targets=('release', 'test', 'publish', 'meta'),
+                     workers=DEFAULT_PHASE_WORKERS):
+        """
+        Build the target phases and the phases they depend on, each once;
+        phases which do not depend on each other are built concurrently
+
+        :return: {phase: PhaseResult}
+        """
+        self._prepare_act()
+        runners = {
+            'prepare': self.build_prepare,
+            'build': partial(self.build_base, use_prepare=True),
+            'release': partial(self.build_release, use_build=True),
+            'test': partial(self.build_test, use_build=True),
+            'publish': partial(self.build_publish, use_build=True),
+            'meta': self.build_meta,
+        }
+        start = time.time()
+        try:
+            results = run_phases(runners, targets, workers)
+        finally:
+            # 本次构建结束，打包好的 context 不再留在 /tmp
+            mydocker.remove_context_tars(self.ctx)
+        report_phases(results, time.time() - start)
+        return results
+
+    def invalidate_phases(self, *phases):
+        """
+        Forget the results of phases and of the phases depending on them
+        """
+        affected = dependent_phases(phases)
+        for key in list(self.phase_results):
+            if key[0] in affected:
+                self.phase_results.pop(key, None)
+
     def _prepare_act(self, ignore_prepare=False):
         if self.act is True:
             return
@@ -378,15 +682,9 @@ class LainYaml(object):
         self.gen_name = partial(mydocker.gen_image_name, appname=self.appname)
 
         phases = ('prepare', 'build', 'release', 'test', 'publish', 'meta')
-        self.img_names = {phase: self.gen_name(phase=phase) for phase in phases}
-        if ignore_prepare:
-            shared_prepare_image_name = None
-        else:
-            shared_prepare_image_name = self.ensure_proper_shared_image()
-        if shared_prepare_image_name is None:
-            self.img_names['prepare'] = self.gen_prepare_shared_image_name()
-        else:
-            self.img_names['prepare'] = shared_prepare_image_name
+        self.img_names = LazyDict((phase, self.gen_name(phase=phase)) for phase in phases)
+        # 查找 prepare image 要访问 registry，到真正用到时才做
+        self.img_names.set_lazy('prepare', partial(self.resolve_prepare_image, ignore_prepare))
 
         j2temps = {
             'prepare': 'build_dockerfile.j2',
@@ -398,15 +696,25 @@ class LainYaml(object):
         }
         self.img_temps = {phase: load_template(j2temps[phase]) for phase in phases}
 
-        self.img_builders = {
-            phase: partial(mydocker.build, name=self.img_names[phase], ignore=self.ignore, template=self.img_temps[phase])
-            for phase in phases
-        }
+        self.img_builders = {phase: self._img_builder(phase) for phase in phases}
+
+        self.release_multistage_temp = load_template('release_multistage_dockerfile.j2')
+        self.release_stream_temp = load_template('release_stream_dockerfile.j2')
 
         self.prepare_updater = partial(mydocker.build, ignore=self.ignore, template=load_template('build_dockerfile.j2'))
 
+        # (phase, ctx, meta_version) -> (True, image_name)
+        self.phase_results = {}
+
         self.act = True
 
+    def _img_builder(self, phase):
+        # 用到时才取 image 的名字，避免提前查找 prepare image
+        def build(**kwargs):
+            return mydocker.build(name=self.img_names[phase], ignore=self.ignore,
+                                  template=self.img_temps[phase], **kwargs)
+        return build
+
     def repo_meta_version(self, sha1=''):
         return meta_version(self.ctx, sha1)
 
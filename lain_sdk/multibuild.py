@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Build the images of several lain apps, such as the apps of a monorepo
+
+    lain_build_apps [-j N] [--phase-jobs N] [--targets release,meta] [path ...]
+
+Paths may be directories, which are walked for lain.yaml files, or
+lain.yaml files. Every missing base image is pulled once, apps sharing a
+prepare image build it once, and up to N apps are built at the same time.
+The images produced and the time spent per app are printed at the end;
+exits 1 when any app fails.
+"""
+
+import optparse
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import mydocker
+from .lain_yaml import LainYaml, PrepareLookups
+from .phases import PHASES, SUCCEEDED, DEFAULT_PHASE_WORKERS, required_phases
+from .util import info, error, warn
+from .yaml.validator.cli import find_lain_yamls
+
+DEFAULT_APP_WORKERS = 4
+DEFAULT_TARGETS = ('release', 'test', 'publish', 'meta')
+
+AppResult = namedtuple('AppResult', ['yaml_path', 'appname', 'ok', 'images', 'duration', 'error'])
+
+
+class AppsBuilder(object):
+    """
+    Build the target phases of many apps on a bounded pool of threads,
+    doing the work they share only once
+    """
+
+    def __init__(self, targets=DEFAULT_TARGETS, workers=DEFAULT_APP_WORKERS,
+                 phase_workers=DEFAULT_PHASE_WORKERS):
+        self.targets = tuple(targets)
+        self.workers = max(workers, 1)
+        self.phase_workers = phase_workers
+        self.pulled = []
+        self.elapsed = None
+        self._lock = threading.Lock()
+        # prepare image name -> [lock, (ok, name)]
+        self._prepares = {}
+        # 这一批 app 共用 prepare image 的查找结果
+        self.prepare_lookups = PrepareLookups()
+
+    @property
+    def prepare_images(self):
+        return sorted(self._prepares)
+
+    def load(self, yaml_paths):
+        """
+        :return: ([(yaml_path, LainYaml)], [AppResult of the apps failed to load])
+        """
+        apps, failures = [], []
+        for path in yaml_paths:
+            try:
+                apps.append((path, LainYaml(path, prepare_lookups=self.prepare_lookups)))
+            except Exception as e:
+                failures.append(AppResult(path, None, False, [], 0, 'invalid lain.yaml: %s' % e))
+        return apps, failures
+
+    def base_images(self, apps):
+        bases = set()
+        for app in apps:
+            bases.add(app.build.base)
+            bases.add(app.release.dest_base)
+        return sorted(b for b in bases if b)
+
+    def pull_bases(self, apps, pool):
+        """
+        Pull each base image missing locally once, instead of once per app
+        """
+        def pull(base):
+            if mydocker.image_id(base) is not None:
+                return None
+            if mydocker.pull(base) != 0:
+                warn('FAILED: docker pull {}'.format(base))
+                return None
+            return base
+        self.pulled = [b for b in pool.map(pull, self.base_images(apps)) if b]
+
+    def ensure_prepare(self, app):
+        """
+        Build the prepare image of app unless another app already did
+
+        :return: (ok, image_name)
+        """
+        name = app.img_names['prepare']
+        with self._lock:
+            entry = self._prepares.setdefault(name, [threading.Lock(), None])
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = app.build_prepare()
+            return entry[1]
+
+    def build_app(self, yaml_path, app):
+        start = time.time()
+        try:
+            if 'prepare' in required_phases(self.targets):
+                ok, _ = self.ensure_prepare(app)
+                if not ok:
+                    return AppResult(yaml_path, app.appname, False, [], time.time() - start,
+                                     'prepare image {} failed'.format(app.img_names['prepare']))
+            results = app.build_phases(self.targets, self.phase_workers)
+        # exit() 也不能让线程池的 worker 退出
+        except (Exception, SystemExit) as e:
+            return AppResult(yaml_path, app.appname, False, [], time.time() - start, repr(e))
+        images = [results[p].image for p in PHASES
+                  if p in results and results[p].status == SUCCEEDED and results[p].image]
+        failed = [p for p in PHASES if p in results and results[p].status != SUCCEEDED]
+        return AppResult(yaml_path, app.appname, not failed, images, time.time() - start,
+                         'phases not built: %s' % ', '.join(failed) if failed else None)
+
+    def run(self, yaml_paths):
+        """
+        :return: [AppResult] in the order of yaml_paths
+        """
+        start = time.time()
+        apps, failures = self.load(yaml_paths)
+        pool = ThreadPool(self.workers)
+        try:
+            self.pull_bases([app for _, app in apps], pool)
+            results = pool.map(lambda a: self.build_app(*a), apps)
+        finally:
+            pool.close()
+            pool.join()
+        self.elapsed = time.time() - start
+        by_path = dict((r.yaml_path, r) for r in results + failures)
+        return [by_path[path] for path in yaml_paths]
+
+
+def report_apps(results, builder):
+    for r in results:
+        msg = '{:<20} {:<9} {:>7.1f}s {}'.format(
+            r.appname or r.yaml_path, 'succeeded' if r.ok else 'failed', r.duration, ' '.join(r.images))
+        if r.ok:
+            info(msg)
+        else:
+            error('{} ({})'.format(msg.rstrip(), r.error))
+    failed = len([r for r in results if not r.ok])
+    info('{} apps built in {:.1f}s, {} failed; {} prepare images, {} base images pulled'.format(
+        len(results), builder.elapsed or 0, failed, len(builder.prepare_images), len(builder.pulled)))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [path ...]')
+    parser.add_option('-H', '--docker-host',
+                      help="used to set DOCKER_HOST env for this process "
+                           "(e.g. tcp://127.0.0.1:8082, unix:///var/run/docker.sock")
+    parser.add_option('-j', '--jobs', type='int', default=DEFAULT_APP_WORKERS,
+                      help="number of apps built at the same time, default is %d" % DEFAULT_APP_WORKERS)
+    parser.add_option('--phase-jobs', type='int', default=DEFAULT_PHASE_WORKERS,
+                      help="number of phases of an app built at the same time, default is %d"
+                           % DEFAULT_PHASE_WORKERS)
+    parser.add_option('--targets', default=','.join(DEFAULT_TARGETS),
+                      help="phases to build, default is %s" % ','.join(DEFAULT_TARGETS))
+    options, paths = parser.parse_args(argv)
+
+    if options.docker_host is not None:
+        os.putenv('DOCKER_HOST', options.docker_host)
+    targets = [t.strip() for t in options.targets.split(',') if t.strip()]
+    try:
+        required_phases(targets)
+        yaml_paths = find_lain_yamls(paths or [os.getcwd()])
+    except Exception as e:
+        parser.error(str(e))
+
+    builder = AppsBuilder(targets, options.jobs, options.phase_jobs)
+    results = builder.run(yaml_paths)
+    report_apps(results, builder)
+    return 0 if all(r.ok for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import atexit
+import json
+import stat
 import shutil
+import tarfile
+import hashlib
 import tempfile
+import threading
+import uuid
 import requests
+from cStringIO import StringIO
 import subprocess
+from functools import partial
 from docker import Client
 from jinja2 import Template
 from .util import (info, error,
@@ -15,6 +25,28 @@ from .util import (info, error,
 
 
 DOCKER_BASE_URL = os.environ.get('DOCKER_HOST', '')
+# 每次 build 生成不同名字的 Dockerfile，同一个 context 可以并发 build
+DOCKERFILE_PREFIX = 'Dockerfile.lain-'
+
+# 内容寻址的 build cache：Dockerfile、build args、base image 和 context 都相同时
+# 直接复用已有的镜像，镜像上用 label 记录 cache key
+BUILD_CACHE_ENABLED = os.environ.get('LAIN_BUILD_CACHE', '1') != '0'
+# context 由 SDK 打包后通过 `docker build -` 发送，LAIN_SDK_CONTEXT=0 时交给 docker client
+SDK_CONTEXT = os.environ.get('LAIN_SDK_CONTEXT', '1') != '0'
+_context_tars = {}
+_context_tar_locks = {}
+_context_tars_lock = threading.Lock()
+BUILD_CACHE_LABEL = 'lain.build-cache'
+BUILD_CACHE_VERSION = 1
+IMAGE_ID_PATTERN = re.compile(r'^(sha256:)?[0-9a-f]{64}$')
+COPY_INSTRUCTION_PATTERN = re.compile(r'^\s*(COPY|ADD)\s+(?!--from=)', re.M | re.I)
+GLOB_CHARS = re.compile(r'[*?\[]')
+COPY_FROM_PATTERN = re.compile(r'^\s*COPY\s+--from=(\S+)', re.M | re.I)
+# `COPY --from=<image>` 从 docker 17.05 开始支持
+MULTISTAGE_MIN_VERSION = (17, 5)
+_server_version = []
+build_cache_stats = {'hits': 0, 'misses': 0}
+_build_cache_lock = threading.Lock()
 
 # Assume `docker` can be run without `sudo`
 
@@ -97,18 +129,62 @@ def gen_dockerignore(path, ignore):
         f.write('# end of lain\n')
 
 
-def build_image(name, context, build_args):
+# 同一个 context 里并发的 build 共用一个 .dockerignore，最后一个 build 结束时才恢复
+_dockerignore_lock = threading.Lock()
+_dockerignore_users = {}
+
+
+def acquire_dockerignore(context, ignore):
+    path = os.path.join(context, '.dockerignore')
+    with _dockerignore_lock:
+        users = _dockerignore_users.get(path)
+        if users is None:
+            gen_dockerignore(path, ignore)
+            _dockerignore_users[path] = [1, list(ignore)]
+            return
+        users[0] += 1
+        missing = [p for p in ignore if p not in users[1]]
+        if missing:
+            with open(path, 'a') as f:
+                for p in missing:
+                    f.write(p + '\n')
+            users[1].extend(missing)
+
+
+def release_dockerignore(context):
+    path = os.path.join(context, '.dockerignore')
+    backup_path = os.path.join(context, '.dockerignore.backup')
+    with _dockerignore_lock:
+        users = _dockerignore_users[path]
+        users[0] -= 1
+        if users[0] > 0:
+            return
+        del _dockerignore_users[path]
+        if os.path.exists(path):
+            rm(path)
+        if os.path.exists(backup_path):
+            shutil.move(backup_path, path)
+
+
+def resolve_build_args(build_args):
+    resolved = []
+    for arg in build_args or []:
+        key, val = arg.split('=', 1)
+        if val.startswith('$'):
+            val = os.environ[val[1:]]
+        resolved.append('{}={}'.format(key, val))
+    return resolved
+
+
+def build_image(name, context, build_args, dockerfile=None):
     info('building image {} ...'.format(name))
-    docker_args = ['build', '-t', name, '.']
-    if build_args:
-        docker_args = ['build', '-t', name]
-        for arg in build_args:
-            key, val = arg.split('=', 1)
-            if val.startswith('$'):
-                val = os.environ[val[1:]]
-            docker_args.append('--build-arg')
-            docker_args.append('{}={}'.format(key, val))
-        docker_args.append('.')
+    docker_args = ['build', '-t', name]
+    if dockerfile is not None:
+        docker_args += ['-f', dockerfile]
+    for arg in resolve_build_args(build_args):
+        docker_args.append('--build-arg')
+        docker_args.append(arg)
+    docker_args.append('.')
     retcode = _docker(docker_args, cwd=context)
     if retcode != 0:
         name = None
@@ -118,23 +194,633 @@ def build_image(name, context, build_args):
     return name
 
 
-def build(name, context, ignore, template, params, build_args):
-    dockerfile_path = os.path.join(context, 'Dockerfile')
-    dockerignore_path = os.path.join(context, '.dockerignore')
-    dockerignore_backup = os.path.join(context, '.dockerignore.backup')
+def image_id(name):
+    if name == 'scratch':
+        return name
+    output = _docker(['inspect', '--format', '{{.Id}}', name], capture_output=True).strip()
+    return output if IMAGE_ID_PATTERN.match(output) else None
+
+
+def read_ignore_file(path):
+    """
+    :return: the patterns of a .dockerignore like file, None when missing
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    return [l.strip() for l in lines if l.strip() and not l.strip().startswith('#')]
+
+
+def read_dockerignore(context):
+    return read_ignore_file(os.path.join(context, '.dockerignore')) or []
+
+
+def context_ignore_patterns(context, ignore):
+    """
+    Patterns of .dockerignore, or of .gitignore when there is none, plus
+    ignore; the same files gen_dockerignore would leave out
+    """
+    patterns = read_ignore_file(os.path.join(context, '.dockerignore'))
+    if patterns is None:
+        patterns = read_ignore_file(os.path.join(context, '.gitignore')) or []
+    # SDK 自己生成 .dockerignore 和 Dockerfile
+    return patterns + list(ignore) + ['.dockerignore', DOCKERFILE_PREFIX + '*']
+
+
+def _pattern_regex(pattern):
+    # 和 docker 的 fileutils 一样把 pattern 翻译成正则
+    regex = '^'
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '*':
+            if pattern[i + 1:i + 2] == '*':
+                i += 1
+                if pattern[i + 1:i + 2] == '/':
+                    i += 1
+                regex += '.*' if i + 1 >= len(pattern) else '(.*/)?'
+            else:
+                regex += '[^/]*'
+        elif ch == '?':
+            regex += '[^/]'
+        elif ch == '[':
+            end = pattern.find(']', i + 1)
+            if end < 0:
+                raise Exception('invalid .dockerignore pattern %s' % pattern)
+            regex += pattern[i:end + 1]
+            i = end
+        elif ch == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(ch)
+        i += 1
+    return re.compile(regex + '$')
+
+
+class DockerIgnore(object):
+    """
+    .dockerignore patterns matched the way docker does: `*` and `?` do not
+    cross `/`, `**` matches any number of directories, a pattern matching
+    a directory leaves out everything in it and the last matching pattern
+    wins, so `!` patterns bring files back
+    """
+
+    def __init__(self, patterns):
+        self.patterns = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            exclusion = pattern.startswith('!')
+            if exclusion:
+                pattern = pattern[1:].strip()
+            pattern = os.path.normpath(pattern)
+            if len(pattern) > 1:
+                pattern = pattern.lstrip('/')
+            self.patterns.append((exclusion, _pattern_regex(pattern), pattern.count('/') + 1))
+        self.has_exclusions = any(exclusion for exclusion, _, _ in self.patterns)
+
+    def matches(self, path):
+        matched = False
+        parent_dirs = path.split('/')[:-1]
+        for exclusion, regex, depth in self.patterns:
+            match = regex.match(path) is not None
+            # 匹配上级目录也算
+            if not match and depth <= len(parent_dirs):
+                match = regex.match('/'.join(parent_dirs[:depth])) is not None
+            if match:
+                matched = not exclusion
+        return matched
+
+
+def walk_context(context, matcher):
+    """
+    Yield (name, path) of the directories and files docker sends for
+    context, parents first and in a stable order
+    """
+    for root, dirs, files in os.walk(context):
+        rel_root = os.path.relpath(root, context)
+        rel = lambda n: n if rel_root == '.' else '%s/%s' % (rel_root, n)
+        # os.walk 把指向目录的软链接当作目录，docker 当作文件
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        # 有 `!` 时被忽略的目录里也可能有要发送的文件
+        dirs[:] = sorted(d for d in dirs if d not in links and
+                         (matcher.has_exclusions or not matcher.matches(rel(d))))
+        for name in dirs:
+            if not matcher.matches(rel(name)):
+                yield rel(name), os.path.join(root, name)
+        for name in sorted(files + links):
+            if not matcher.matches(rel(name)):
+                yield rel(name), os.path.join(root, name)
+
+
+def context_digest(context, patterns):
+    """
+    sha256 of the relative paths, modes and contents of the files docker
+    would send for context, minus the ones matched by patterns
+    """
+    digest = hashlib.sha256()
+    for name, path in walk_context(context, DockerIgnore(patterns)):
+        if not os.path.isdir(path) or os.path.islink(path):
+            _update_file_digest(digest, path, name)
+    return digest.hexdigest()
+
+
+def files_digest(context, names):
+    digest = hashlib.sha256()
+    for name in names:
+        _update_file_digest(digest, os.path.join(context, name), name)
+    return digest.hexdigest()
+
+
+def _update_file_digest(digest, path, name):
+    st = os.lstat(path)
+    _update_header_digest(digest, name, st)
+    if stat.S_ISLNK(st.st_mode):
+        digest.update(os.readlink(path))
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(chunk)
+    digest.update('\0')
+
+
+def _update_header_digest(digest, name, st):
+    digest.update('%s\0%o\0' % (name, stat.S_IMODE(st.st_mode)))
+
+
+def context_sources(dockerfile_content):
+    """
+    :return: the context paths used by COPY/ADD of the Dockerfile, None
+             when they can not be told, such as the json form
+    """
+    sources = []
+    for line in dockerfile_content.splitlines():
+        parts = line.split()
+        if not parts or parts[0].upper() not in ('COPY', 'ADD'):
+            continue
+        args = [a for a in parts[1:] if not a.startswith('--')]
+        if any(a.startswith('--from=') for a in parts[1:]):
+            continue
+        if '[' in line or len(args) < 2:
+            return None
+        sources.extend(args[:-1])
+    return sources
+
+
+def minimal_context_files(context, sources, patterns):
+    """
+    :return: the files to send instead of the whole context when sources
+             are plain files which are not ignored, None otherwise
+    """
+    matcher = DockerIgnore(patterns)
+    files = []
+    for source in sources:
+        name = os.path.normpath(source)
+        path = os.path.join(context, name)
+        if name.startswith('..') or name == '.' or GLOB_CHARS.search(name) or matcher.matches(name) \
+                or os.path.islink(path) or not os.path.isfile(path):
+            return None
+        if name not in files:
+            files.append(name)
+    return files
+
+
+def add_context_files(context, names, tar):
+    for name in names:
+        tar.add(os.path.join(context, name), arcname=name, recursive=False)
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}GB'.format(size)
+
+
+class ContextTar(object):
+    """
+    The files docker would send for a context, tarred once into a temp
+    file; every build writes the members as they are into its context
+    stream after its own Dockerfile
+    """
+
+    def __init__(self, context, patterns):
+        self.context = context
+        self.matcher = DockerIgnore(patterns)
+        self.signature = self.stat_signature()
+        self.files = 0
+        digest = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(prefix='lain-context-', suffix='.tar')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for name, path in walk_context(context, self.matcher):
+                    self._add(out, name, path, digest)
+            self.size = os.path.getsize(self.path)
+        except:
+            self.remove()
+            raise
+        self.digest = digest.hexdigest()
+
+    def _add(self, out, name, path, digest):
+        st = os.lstat(path)
+        member = tarfile.TarInfo(name)
+        member.mode = stat.S_IMODE(st.st_mode)
+        member.mtime = int(st.st_mtime)
+        if stat.S_ISDIR(st.st_mode):
+            member.type = tarfile.DIRTYPE
+            out.write(member.tobuf(tarfile.GNU_FORMAT))
+            return
+        if stat.S_ISLNK(st.st_mode):
+            member.type = tarfile.SYMTYPE
+            member.linkname = os.readlink(path)
+            out.write(member.tobuf(tarfile.GNU_FORMAT))
+            _update_header_digest(digest, name, st)
+            digest.update(member.linkname + '\0')
+            self.files += 1
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        member.size = st.st_size
+        out.write(member.tobuf(tarfile.GNU_FORMAT))
+        _update_header_digest(digest, name, st)
+        written = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(min(1024 * 1024, member.size - written)), ''):
+                out.write(chunk)
+                digest.update(chunk)
+                written += len(chunk)
+                if written == member.size:
+                    break
+        if written != member.size:
+            raise Exception('{} changed while building the context'.format(path))
+        digest.update('\0')
+        if member.size % tarfile.BLOCKSIZE:
+            out.write(tarfile.NUL * (tarfile.BLOCKSIZE - member.size % tarfile.BLOCKSIZE))
+        self.files += 1
+
+    def stat_signature(self):
+        signature = hashlib.sha1()
+        for name, path in walk_context(self.context, self.matcher):
+            st = os.lstat(path)
+            signature.update('%s\0%d\0%d\0%o\0' % (name, st.st_mtime * 1e6, st.st_size, st.st_mode))
+        return signature.hexdigest()
+
+    def is_fresh(self):
+        return os.path.exists(self.path) and self.stat_signature() == self.signature
+
+    def add_to(self, tar):
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                tar.fileobj.write(chunk)
+                tar.offset += len(chunk)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            rm(self.path)
+
+
+def get_context_tar(context, patterns):
+    """
+    :return: the ContextTar of context, built once and reused until a file
+             in it changes
+    """
+    _remove_gone_context_tars()
+    key = (os.path.realpath(context), tuple(patterns))
+    # 只在操作字典时持有全局锁，不同 context 的 tar 可以同时打包
+    with _context_tars_lock:
+        key_lock = _context_tar_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with _context_tars_lock:
+            context_tar = _context_tars.get(key)
+        if context_tar is not None and context_tar.is_fresh():
+            info('reusing build context of {}: {} files, {}'.format(
+                context, context_tar.files, _format_size(context_tar.size)))
+            return context_tar
+        if context_tar is not None:
+            context_tar.remove()
+        context_tar = ContextTar(context, patterns)
+        with _context_tars_lock:
+            _context_tars[key] = context_tar
+    info('built build context of {}: {} files, {}'.format(
+        context, context_tar.files, _format_size(context_tar.size)))
+    return context_tar
+
+
+def _remove_gone_context_tars():
+    with _context_tars_lock:
+        gone = [key for key in _context_tars if not os.path.isdir(key[0])]
+        for key in gone:
+            _context_tars.pop(key).remove()
+            _context_tar_locks.pop(key, None)
+
+
+@atexit.register
+def remove_context_tars(context=None):
+    """
+    Remove the context tars of context, of every context by default
+    """
+    path = os.path.realpath(context) if context is not None else None
+    with _context_tars_lock:
+        for key in list(_context_tars):
+            if path is None or key[0] == path:
+                _context_tars.pop(key).remove()
+                _context_tar_locks.pop(key, None)
+
+
+def dockerfile_base(dockerfile_content):
+    for line in dockerfile_content.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].upper() == 'FROM':
+            return parts[1]
+    return None
+
+
+def build_cache_key(context, dockerfile_content, build_args, digest=None):
+    """
+    :param digest: digest of the context given by the caller, context is
+                   not walked when set
+    :return: cache key of a build, None when the base image is not local
+    """
+    base = dockerfile_base(dockerfile_content)
+    base_id = image_id(base) if base else None
+    if base_id is None:
+        return None
+    # COPY --from 的镜像和 base image 一样要算进 key
+    source_ids = [image_id(source) for source in COPY_FROM_PATTERN.findall(dockerfile_content)]
+    if None in source_ids:
+        return None
+    key = hashlib.sha256(json.dumps(
+        [BUILD_CACHE_VERSION, dockerfile_content, resolve_build_args(build_args), base_id, source_ids]))
+    # 没有从 context COPY/ADD 的 Dockerfile 和 context 的内容无关
+    if COPY_INSTRUCTION_PATTERN.search(dockerfile_content):
+        if digest is None and context is None:
+            return None
+        key.update(digest or context_digest(context, read_dockerignore(context)))
+    return key.hexdigest()
+
+
+def split_image_name(name):
+    """
+    registry/repo:tag -> (registry or None, repo, tag)
+    """
+    repo, tag = name, 'latest'
+    if ':' in name.rsplit('/', 1)[-1]:
+        repo, tag = name.rsplit(':', 1)
+    parts = repo.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        return parts[0], parts[1], tag
+    return None, repo, tag
+
+
+def _get_manifest_in_registry(name, method='get'):
+    registry, repo, tag = split_image_name(name)
+    if registry is None:
+        return None
+    manifest_url = "http://%s/v2/%s/manifests/%s" % (registry, repo, tag)
+    need_auth, auth_url = parse_registry_auth(registry)
+    if need_auth:
+        jwt = get_jwt_for_registry(auth_url, registry, repo)
+        headers = {'Authorization': 'Bearer %s' % jwt}
+    else:
+        headers = None
+    return getattr(requests, method)(manifest_url, headers=headers,
+            timeout=(REGISTRY_CONNECT_TIMEOUT, REGISTRY_READ_TIMEOUT))
+
+
+def exist_in_registry(name):
+    try:
+        r = _get_manifest_in_registry(name, 'head')
+        return r is not None and r.status_code == 200
+    except:
+        return False
+
+
+def get_image_labels_in_registry(name):
+    try:
+        r = _get_manifest_in_registry(name)
+        # schema1 manifest 的 history 里有镜像的 config
+        v1 = json.loads(r.json()['history'][0]['v1Compatibility'])
+        return (v1.get('config') or {}).get('Labels') or {}
+    except:
+        return {}
+
+
+def find_cached_image(name, key):
+    """
+    Make `name` point to an image built with cache key `key`
+
+    :return: 'local' or 'registry' where the image was found, or None
+    """
+    ids = _docker(['images', '-q', '--no-trunc', '--filter',
+                   'label={}={}'.format(BUILD_CACHE_LABEL, key)], capture_output=True).split()
+    ids = [i for i in ids if IMAGE_ID_PATTERN.match(i)]
+    if ids and (image_id(name) == ids[0] or tag(ids[0], name) == 0):
+        return 'local'
+    if get_image_labels_in_registry(name).get(BUILD_CACHE_LABEL) == key and pull(name) == 0:
+        return 'registry'
+    return None
+
+
+def _count_build_cache(kind):
+    with _build_cache_lock:
+        build_cache_stats[kind] += 1
+
+
+def lookup_build_cache(name, key):
+    """
+    :return: True when name now points to the image built with key
+    """
+    found = find_cached_image(name, key)
+    if found:
+        _count_build_cache('hits')
+        info('build cache hit ({}): {}'.format(found, name))
+        return True
+    _count_build_cache('misses')
+    info('build cache miss: {} (key {})'.format(name, key[:12]))
+    return False
+
+
+def cache_label(key):
+    return '\nLABEL {}={}\n'.format(BUILD_CACHE_LABEL, key)
+
+
+def build(name, context, ignore, template, params, build_args, use_cache=None):
+    # 只发送 Dockerfile 用到的文件：不 COPY 的发空 context，只 COPY 几个文件的只发这些文件
+    sources = context_sources(Template(template).render(params))
+    patterns = context_ignore_patterns(context, ignore)
+    if sources is not None:
+        files = minimal_context_files(context, sources, patterns)
+        if files is not None:
+            return build_from_stream(name, template, params, partial(add_context_files, context, files),
+                                     files_digest(context, files), use_cache, build_args)
+    if SDK_CONTEXT:
+        context_tar = get_context_tar(context, patterns)
+        return build_from_stream(name, template, params, context_tar.add_to,
+                                 context_tar.digest, use_cache, build_args)
+
+    dockerfile = DOCKERFILE_PREFIX + uuid.uuid4().hex[:12]
+    dockerfile_path = os.path.join(context, dockerfile)
+    if use_cache is None:
+        use_cache = BUILD_CACHE_ENABLED
+    # 生成的 Dockerfile 不要被 COPY 进镜像
+    acquire_dockerignore(context, list(ignore) + [DOCKERFILE_PREFIX + '*'])
     try:
         gen_dockerfile(dockerfile_path, template, params)
-        gen_dockerignore(dockerignore_path, ignore)
-        name = build_image(name, context, build_args)
+        key = None
+        if use_cache:
+            with open(dockerfile_path) as f:
+                key = build_cache_key(context, f.read(), build_args)
+        if key is not None:
+            if lookup_build_cache(name, key):
+                return name
+            with open(dockerfile_path, 'a') as f:
+                f.write(cache_label(key))
+        name = build_image(name, context, build_args, dockerfile)
     finally:
-        for path in [dockerfile_path, dockerignore_path]:
-            if os.path.exists(path):
-                rm(path)
-        if os.path.exists(dockerignore_backup):
-            shutil.move(dockerignore_backup, dockerignore_path)
+        if os.path.exists(dockerfile_path):
+            rm(dockerfile_path)
+        release_dockerignore(context)
     return name
 
 
+def _docker_popen(args, **kwargs):
+    return subprocess.Popen(['docker'] + args, env={'DOCKER_HOST': ''}, **kwargs)
+
+
+def _add_tar_bytes(tar, name, content):
+    member = tarfile.TarInfo(name)
+    member.size = len(content)
+    member.mode = 0644
+    tar.addfile(member, StringIO(content))
+
+
+def build_from_stream(name, template, params, write_context, digest=None, use_cache=None, build_args=None):
+    """
+    Build with a context tar streamed into `docker build -`, nothing is
+    written to disk
+
+    :param write_context: callable adding the context files to a tarfile
+                          opened in stream mode, the Dockerfile is added
+    :param digest: digest of what write_context adds, used in the cache
+                   key; without it the build cache is only used when the
+                   Dockerfile copies nothing from the context
+    :return: image name or None
+    """
+    if use_cache is None:
+        use_cache = BUILD_CACHE_ENABLED
+    dockerfile_content = Template(template).render(params)
+    key = build_cache_key(None, dockerfile_content, build_args, digest) if use_cache else None
+    if key is not None:
+        if lookup_build_cache(name, key):
+            return name
+        dockerfile_content += cache_label(key)
+
+    info('building image {} from stream ...'.format(name))
+    dockerfile = DOCKERFILE_PREFIX + uuid.uuid4().hex[:12]
+    docker_args = ['build', '-t', name, '-f', dockerfile]
+    for arg in resolve_build_args(build_args):
+        docker_args += ['--build-arg', arg]
+    proc = _docker_popen(docker_args + ['-'], stdin=subprocess.PIPE)
+    try:
+        tar = tarfile.open(fileobj=proc.stdin, mode='w|')
+        _add_tar_bytes(tar, dockerfile, dockerfile_content.encode('utf-8'))
+        # docker 读完 Dockerfile 后会删掉 .dockerignore 里列出的这两个文件，不会被 COPY 进镜像
+        _add_tar_bytes(tar, '.dockerignore', '.dockerignore\n{}\n'.format(dockerfile))
+        write_context(tar)
+        tar.close()
+        proc.stdin.close()
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.wait() != 0:
+        error('build image {} failed'.format(name))
+        return None
+    info('build image {} success'.format(name))
+    return name
+
+
+def create_container(image):
+    output = _docker(['create', image], capture_output=True).strip()
+    container_id = output.splitlines()[-1] if output else ''
+    if not re.match(r'^[0-9a-f]{64}$', container_id):
+        raise Exception('failed to create container of {}: {}'.format(image, output))
+    return container_id
+
+
+def export_paths(image, copy_list, tar, prefix='release'):
+    """
+    Stream the files of image under each src of copy_list into tar as
+    `<prefix>/<index>`, read from `docker export` of a created container;
+    only one member is in memory at a time
+
+    :param copy_list: [(src, dest)], src are absolute paths in image
+    :return: the names in tar, in the order of copy_list
+    """
+    sources = [src.strip('/') for src, _ in copy_list]
+    names = ['%s/%d' % (prefix, i) for i in range(len(copy_list))]
+    found = set()
+    renamed = {}
+
+    def rename(path):
+        for i, src in enumerate(sources):
+            if path == src or path.startswith(src + '/'):
+                return names[i] + path[len(src):], i
+        return None, None
+
+    container_id = create_container(image)
+    proc = _docker_popen(['export', container_id], stdout=subprocess.PIPE)
+    try:
+        exported = tarfile.open(fileobj=proc.stdout, mode='r|')
+        for member in exported:
+            path = os.path.normpath(member.name).lstrip('/')
+            new_name, index = rename(path)
+            if new_name is None:
+                continue
+            found.add(index)
+            renamed[path] = new_name
+            if member.islnk():
+                # 硬链接只能指向已经写入的文件
+                target = os.path.normpath(member.linkname).lstrip('/')
+                if target not in renamed:
+                    raise Exception('hard link {} points outside of release.copy'.format(path))
+                member.linkname = renamed[target]
+            member.name = new_name
+            tar.addfile(member, exported.extractfile(member) if member.isreg() else None)
+        exported.close()
+        if proc.wait() != 0:
+            raise Exception('failed to export container of {}'.format(image))
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        _docker(['rm', '-f', container_id], print_stdout=False)
+    missing = [copy_list[i][0] for i in range(len(copy_list)) if i not in found]
+    if missing:
+        raise Exception('{} not found in {}'.format(', '.join(missing), image))
+    return names
+
+
+def server_version():
+    """
+    :return: (major, minor) of the docker daemon, (0, 0) when unknown
+    """
+    if not _server_version:
+        output = _docker(['version', '--format', '{{.Server.Version}}'], capture_output=True)
+        match = re.match(r'^(\d+)\.(\d+)', output.strip())
+        _server_version.append((int(match.group(1)), int(match.group(2))) if match else (0, 0))
+    return _server_version[0]
+
+
+def supports_multistage():
+    return server_version() >= MULTISTAGE_MIN_VERSION
+
+
 def get_latest_container_id():
     try:
         output = _docker(['ps', '-l', '-q'], capture_output=True)
@@ -149,6 +835,26 @@ def get_latest_container_id():
     return container_id
 
 
+def get_failed_container_id(base, scripts):
+    """
+    :return: id of the latest container left by a failed `RUN scripts`
+             built on top of base, -1 when there is none
+    """
+    # 同时 build 的其他 phase 和 app 也会留下容器，`docker ps -l` 拿到的不一定是自己的
+    output = _docker(['ps', '-a', '-q', '--no-trunc', '--filter', 'ancestor=' + base,
+                      '--filter', 'status=exited'], capture_output=True)
+    cmd = ['/bin/sh', '-c', ' && '.join(scripts)]
+    for container_id in output.split():
+        try:
+            container_cmd = json.loads(_docker(['inspect', '--format', '{{json .Config.Cmd}}', container_id],
+                                               capture_output=True))
+        except ValueError:
+            continue
+        if container_cmd == cmd:
+            return container_id
+    return -1
+
+
 def remove_container(container_id):
     info('removing container {} ...'.format(container_id))
     _docker(['kill', container_id])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from Queue import Queue
+from collections import namedtuple
+
+from .util import info, error, warn
+
+PHASES = ('prepare', 'build', 'release', 'test', 'publish', 'meta')
+# meta 镜像只包含 lain.yaml，不依赖 build 镜像
+PHASE_DEPENDENCIES = {
+    'prepare': (),
+    'build': ('prepare', ),
+    'release': ('build', ),
+    'test': ('build', ),
+    'publish': ('build', ),
+    'meta': (),
+}
+DEFAULT_PHASE_WORKERS = 4
+
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+PhaseResult = namedtuple('PhaseResult', ['phase', 'status', 'image', 'started', 'duration'])
+
+
+def required_phases(targets, dependencies=PHASE_DEPENDENCIES):
+    """
+    :return: targets and everything they depend on
+    """
+    needed = set()
+    stack = list(targets)
+    while stack:
+        phase = stack.pop()
+        if phase not in dependencies:
+            raise Exception('unknown phase %s' % phase)
+        if phase not in needed:
+            needed.add(phase)
+            stack.extend(dependencies[phase])
+    return needed
+
+
+def dependent_phases(phases, dependencies=PHASE_DEPENDENCIES):
+    """
+    :return: phases and everything depending on them
+    """
+    affected = set(phases)
+    changed = True
+    while changed:
+        changed = False
+        for phase, deps in dependencies.iteritems():
+            if phase not in affected and affected.intersection(deps):
+                affected.add(phase)
+                changed = True
+    return affected
+
+
+def run_phases(runners, targets, workers=DEFAULT_PHASE_WORKERS, dependencies=PHASE_DEPENDENCIES):
+    """
+    Run the phases of targets and their dependencies, each once, with up to
+    `workers` phases running at the same time. A phase starts as soon as
+    all its dependencies succeeded and is skipped when one of them did not.
+
+    :param runners: {phase: callable returning (ok, image_name)}
+    :return: {phase: PhaseResult}
+    """
+    order = [p for p in PHASES if p in dependencies] + sorted(set(dependencies) - set(PHASES))
+    waiting = [p for p in order if p in required_phases(targets, dependencies)]
+    finished = Queue()
+    running = set()
+    results = {}
+
+    def _run(phase):
+        started = time.time()
+        ok, image = False, None
+        try:
+            ok, image = runners[phase]()
+        # exit() 也要有结果，否则等待的线程永远拿不到
+        except BaseException as e:
+            error('phase {} raised {!r}'.format(phase, e))
+        finally:
+            status = SUCCEEDED if ok else FAILED
+            finished.put(PhaseResult(phase, status, image, started, time.time() - started))
+
+    while waiting or running:
+        for phase in list(waiting):
+            deps = [results.get(d) for d in dependencies[phase]]
+            if any(r is not None and r.status != SUCCEEDED for r in deps):
+                waiting.remove(phase)
+                results[phase] = PhaseResult(phase, SKIPPED, None, None, 0)
+            elif all(r is not None for r in deps) and len(running) < max(workers, 1):
+                waiting.remove(phase)
+                running.add(phase)
+                t = threading.Thread(target=_run, args=(phase, ), name='phase-%s' % phase)
+                t.daemon = True
+                t.start()
+        if running:
+            result = finished.get()
+            running.remove(result.phase)
+            results[result.phase] = result
+    return results
+
+
+def report_phases(results, elapsed=None):
+    for phase in [p for p in PHASES if p in results] + sorted(set(results) - set(PHASES)):
+        r = results[phase]
+        msg = '{:<8} {:<10} {:>7.1f}s {}'.format(phase, r.status, r.duration, r.image or '')
+        if r.status == SUCCEEDED:
+            info(msg)
+        elif r.status == FAILED:
+            error(msg)
+        else:
+            warn(msg)
+    if elapsed is not None:
+        info('{} phases finished in {:.1f}s'.format(len(results), elapsed))
@@ -3,7 +3,10 @@
 
 import logging
 import os
+import sys
 import copy
+import threading
+import collections
 from sys import stderr
 import errno
 import subprocess
@@ -60,6 +63,84 @@ def recur_create_file(path):
     open(path, 'a').close()
 
 
+def run_concurrently(*calls):
+    """
+    Call each callable in its own thread and wait for all of them
+
+    :return: the results in the order of calls; the first exception raised
+             is raised again once every call finished
+    """
+    results = [None] * len(calls)
+    errors = []
+
+    def _run(i, call):
+        try:
+            results[i] = call()
+        except BaseException:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=_run, args=(i, call)) for i, call in enumerate(calls)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class LazyDict(collections.MutableMapping):
+    """
+    dict of which some values are given by set_lazy as callables, called
+    once on the first access of the key
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._values = dict(*args, **kwargs)
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def set_lazy(self, key, resolve):
+        with self._lock:
+            self._values.pop(key, None)
+            self._pending[key] = resolve
+
+    def is_resolved(self, key):
+        return key not in self._pending
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            with self._lock:
+                if key in self._pending:
+                    self._values[key] = self._pending[key]()
+                    del self._pending[key]
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._values[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self._pending.pop(key, None) is None:
+                del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._pending
+
+    def __iter__(self):
+        return iter(list(self._values) + list(self._pending))
+
+    def __len__(self):
+        return len(self._values) + len(self._pending)
+
+    def __repr__(self):
+        values = dict(self._values, **dict((k, '<lazy>') for k in self._pending))
+        return '%s(%r)' % (self.__class__.__name__, values)
+
+
 def file_parent_dir(path):
     return os.path.dirname(os.path.abspath(path))
 
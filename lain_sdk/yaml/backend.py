@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .parser import LainConf
+from . import lua_backend
+
+BACKENDS = ('python', 'lua')
+
+
+def load_lain_conf(meta_yaml, meta_version, default_image, backend='python', **cluster_config):
+    """
+    Load a lain.yaml with the selected parser backend
+
+    :return: LainConf
+    """
+    if backend == 'python':
+        conf = LainConf()
+        conf.load(meta_yaml, meta_version, default_image, **cluster_config)
+        return conf
+    elif backend == 'lua':
+        return lua_backend.load(meta_yaml, meta_version, default_image, **cluster_config)
+    raise Exception('unknown parser backend %s, should be one of %s' % (backend, BACKENDS))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import yaml
+
+
+class LoadLimitError(Exception):
+    pass
+
+
+class LoadLimits(object):
+    """
+    Resource limits enforced while a lain.yaml is being loaded
+
+    Every limit can be set to None to disable it.
+
+    max_bytes:       size of the raw input, unicode is counted as UTF-8
+    max_depth:       nesting depth of collections
+    max_aliases:     number of `*alias` references
+    max_nodes:       number of nodes once every alias is expanded
+    max_procs:       number of top level proc sections
+    max_list_items:  total length of all sequences, aliases expanded
+    """
+
+    def __init__(self, max_bytes=128 * 1024, max_depth=64, max_aliases=256,
+                 max_nodes=100000, max_procs=256, max_list_items=10000):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_aliases = max_aliases
+        self.max_nodes = max_nodes
+        self.max_procs = max_procs
+        self.max_list_items = max_list_items
+
+
+DEFAULT_LOAD_LIMITS = LoadLimits()
+
+
+def _exceeded(limit, value):
+    return limit is not None and value > limit
+
+
+def _byte_size(data):
+    # unicode 按字符计数会让非 ASCII 的输入超出限制好几倍
+    if isinstance(data, unicode):
+        return len(data.encode('utf-8'))
+    return len(data)
+
+
+class _LimitedStream(object):
+
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.name = getattr(stream, 'name', '<file>')
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += _byte_size(data)
+        if _exceeded(self.max_bytes, self.size):
+            raise LoadLimitError('lain.yaml is larger than %d bytes' % self.max_bytes)
+        return data
+
+
+class GuardedLoader(yaml.SafeLoader):
+    """
+    SafeLoader which checks LoadLimits while composing the node graph,
+    before any python object is constructed.
+    """
+
+    def __init__(self, stream, limits, proc_keywords=()):
+        yaml.SafeLoader.__init__(self, stream)
+        self.limits = limits
+        self.proc_keywords = proc_keywords
+        self._depth = 0
+        self._aliases = 0
+        self._procs = 0
+        self._nodes = 0
+        self._items = 0
+        self._open_anchors = set()
+
+    def _fail(self, msg):
+        mark = self.peek_event().start_mark
+        raise LoadLimitError('%s, at line %d column %d' % (msg, mark.line + 1, mark.column + 1))
+
+    def compose_node(self, parent, index):
+        limits = self.limits
+        # 边解析边计数，不用等整个集合解析完才发现超限
+        self._nodes += 1
+        if _exceeded(limits.max_nodes, self._nodes):
+            self._fail('more than %d nodes' % limits.max_nodes)
+        if isinstance(parent, yaml.SequenceNode):
+            self._items += 1
+            if _exceeded(limits.max_list_items, self._items):
+                self._fail('more than %d list items in total' % limits.max_list_items)
+
+        if self.check_event(yaml.AliasEvent):
+            anchor = self.peek_event().anchor
+            if anchor in self._open_anchors:
+                self._fail('recursive alias *%s' % anchor)
+            self._aliases += 1
+            if _exceeded(limits.max_aliases, self._aliases):
+                self._fail('more than %d aliases' % limits.max_aliases)
+            return yaml.SafeLoader.compose_node(self, parent, index)
+
+        if self._depth == 1 and isinstance(index, yaml.ScalarNode) \
+                and index.value.split('.')[0] in self.proc_keywords:
+            self._procs += 1
+            if _exceeded(limits.max_procs, self._procs):
+                self._fail('more than %d procs' % limits.max_procs)
+
+        anchor = self.peek_event().anchor
+        if anchor is not None:
+            self._open_anchors.add(anchor)
+        self._depth += 1
+        if _exceeded(limits.max_depth, self._depth):
+            self._fail('nested deeper than %d levels' % limits.max_depth)
+        try:
+            node = yaml.SafeLoader.compose_node(self, parent, index)
+        finally:
+            self._depth -= 1
+            self._open_anchors.discard(anchor)
+
+        # 计算展开所有 alias 后的节点数和列表长度，alias 指向的节点会被重复计入
+        nodes, items = 1, 0
+        if isinstance(node, yaml.SequenceNode):
+            children = node.value
+            items = len(children)
+        elif isinstance(node, yaml.MappingNode):
+            children = [n for pair in node.value for n in pair]
+        else:
+            children = []
+        for child in children:
+            nodes += child.lain_nodes
+            items += child.lain_items
+        node.lain_nodes, node.lain_items = nodes, items
+        if _exceeded(limits.max_nodes, nodes):
+            self._fail('more than %d nodes after alias expansion' % limits.max_nodes)
+        if _exceeded(limits.max_list_items, items):
+            self._fail('more than %d list items in total' % limits.max_list_items)
+        return node
+
+
+def guarded_load(source, limits=DEFAULT_LOAD_LIMITS, proc_keywords=()):
+    """
+    yaml.safe_load with LoadLimits, source is yaml text or a stream
+    """
+    if isinstance(source, basestring):
+        if _exceeded(limits.max_bytes, _byte_size(source)):
+            raise LoadLimitError('lain.yaml is larger than %d bytes' % limits.max_bytes)
+    else:
+        source = _LimitedStream(source, limits.max_bytes)
+    loader = GuardedLoader(source, limits, proc_keywords)
+    try:
+        return loader.get_single_data()
+    finally:
+        loader.dispose()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from .parser import Proc
+
+
+def _fork(proc):
+    # 浅拷贝：新 proc 与原 proc 共享所有字段对象
+    forked = Proc()
+    forked.__dict__.update(proc.__dict__)
+    return forked
+
+
+class ProcRevision(object):
+    """
+    One revision of a proc kept by ProcHistory.
+
+    `proc` shares every field object that did not change with the parent
+    revision, `changed` is the set of field names this revision touched.
+    Revisions must be treated as read-only.
+    """
+
+    def __init__(self, number, proc, parent=None, changed=()):
+        self.number = number
+        self.proc = proc
+        self.parent = parent
+        self.changed = frozenset(changed)
+
+
+class ProcHistory(object):
+    """
+    Revision history of a parsed proc with structural sharing
+
+    Every `patch` / `patch_only_simple_scale_meta` appends a new revision
+    instead of deep copying the proc, so the history costs one field table
+    per revision plus the fields that actually changed.
+    """
+
+    def __init__(self, proc):
+        self.revisions = [ProcRevision(0, _fork(proc))]
+
+    def __len__(self):
+        return len(self.revisions)
+
+    def __getitem__(self, number):
+        return self.revisions[number]
+
+    def __iter__(self):
+        return iter(self.revisions)
+
+    @property
+    def latest(self):
+        return self.revisions[-1]
+
+    def patch(self, payload):
+        return self._record(lambda proc: proc.patch(payload))
+
+    def patch_only_simple_scale_meta(self, proc):
+        return self._record(lambda p: p.patch_only_simple_scale_meta(proc))
+
+    def _record(self, apply_patch):
+        parent = self.latest
+        proc = _fork(parent.proc)
+        apply_patch(proc)
+        old_fields, new_fields = parent.proc.__dict__, proc.__dict__
+        changed = []
+        for k, v in new_fields.items():
+            old = old_fields.get(k, getattr(Proc, k, None))
+            if v is old:
+                continue
+            if v == old:
+                # 值没变但是生成了新对象，换回父 revision 的对象以共享内存
+                if k in old_fields:
+                    new_fields[k] = old
+                continue
+            changed.append(k)
+        revision = ProcRevision(len(self.revisions), proc, parent, changed)
+        self.revisions.append(revision)
+        return revision
+
+    def diff(self, a, b=-1):
+        """
+        :return: {field: (value_in_a, value_in_b)} of fields differing between revisions a and b
+        """
+        ra, rb = self.revisions[a], self.revisions[b]
+        lo, hi = sorted([ra.number, rb.number])
+        candidates = set()
+        for revision in self.revisions[lo + 1:hi + 1]:
+            candidates |= revision.changed
+        diff = {}
+        for k in candidates:
+            va, vb = getattr(ra.proc, k), getattr(rb.proc, k)
+            if va is not vb and va != vb:
+                diff[k] = (va, vb)
+        return diff
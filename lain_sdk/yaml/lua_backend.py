@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+LainConf backend running lua_parser/jsonCompletion.lua through lupa
+
+The lain.yaml is decoded in python (with the same LoadLimits as LainConf),
+handed to a pooled LuaRuntime through globals and completed by the lua
+code. The completed procs are converted into Proc objects, while the
+build/release/test/publish sections, which the lua code only passes
+through, are loaded by the python section classes. The lua code knows
+nothing about registries, so procs without image get the same default
+image as LainConf.
+"""
+
+import os
+import threading
+from Queue import Queue, Empty
+
+try:
+    import lupa
+except ImportError:
+    lupa = None
+
+from .guard import guarded_load
+from .util import yaml_stream
+from .parser import (LainConf, Proc, Port, Build, Release, Test, Publish,
+                     ProcType, SocketType, is_section)
+from ..mydocker import gen_image_name
+from .conf import PRIVATE_REGISTRY
+from ..util import get_cfd, lain_based_path
+
+LUA_AVAILABLE = lupa is not None
+LUA_PARSER_DIR = os.path.join(get_cfd(__file__), 'lua_parser')
+LUA_COMPLETION_SCRIPT = os.path.join(LUA_PARSER_DIR, 'jsonCompletion.lua')
+DEFAULT_POOL_SIZE = 4
+
+# jsonCompletion.lua 里的枚举值
+LUA_PROC_TYPES = {0: ProcType.worker, 1: ProcType.web, 2: ProcType.oneshot, 3: ProcType.portal}
+LUA_SOCKET_TYPES = {0: SocketType.tcp, 1: SocketType.udp}
+
+
+def _new_runtime():
+    # encoding=None: lua string 以 str 返回，和 yaml.safe_load 的结果一致
+    lua = lupa.LuaRuntime(unpack_returned_tuples=True, encoding=None)
+    lua.execute("package.path = '%s/?.lua;' .. package.path" % LUA_PARSER_DIR)
+    # jsonCompletion.lua 的调试输出太多，在 pool 里直接丢弃
+    lua.execute("print = function(...) end")
+    lua.execute("dofile('%s')" % LUA_COMPLETION_SCRIPT)
+    return lua
+
+
+class LuaRuntimePool(object):
+    """
+    Pool of LuaRuntime instances with jsonCompletion.lua already loaded
+
+    Runtimes are created lazily up to `size` and reused; a LuaRuntime is
+    not thread safe, so each one is used by a single caller at a time.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        if not LUA_AVAILABLE:
+            raise Exception('lua backend needs lupa, please `pip install lupa` first')
+        self.size = size
+        self._idle = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return _new_runtime()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, lua):
+        self._idle.put(lua)
+
+    def complete(self, meta, repo_name, meta_version):
+        lua = self.acquire()
+        try:
+            g = lua.globals()
+            g.lain_meta = _to_lua(lua, meta)
+            g.repo_name = repo_name
+            g.meta_version = meta_version
+            try:
+                return _to_python(lua.eval('getDataFromGlobals()'))
+            except lupa.LuaError as e:
+                raise Exception('lua parser: %s' % str(e).split('\n')[0])
+            finally:
+                g.lain_meta = None
+                g.data = None
+        finally:
+            self.release(lua)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = LuaRuntimePool()
+        return _default_pool
+
+
+def _to_lua(lua, obj):
+    if isinstance(obj, dict):
+        return lua.table_from(dict((_to_lua(lua, k), _to_lua(lua, v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return lua.table_from([_to_lua(lua, v) for v in obj])
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+
+def _to_python(obj):
+    if lupa.lua_type(obj) != 'table':
+        return obj
+    items = [(k, _to_python(v)) for k, v in obj.items()]
+    keys = [k for k, _ in items]
+    if keys and sorted(keys) == range(1, len(keys) + 1):
+        return [v for _, v in sorted(items)]
+    return dict(items)
+
+
+def _as_list(value):
+    # lua 的空 table 无法区分 list 和 dict
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _exec_form(value):
+    if isinstance(value, basestring):
+        return value.split()
+    return _as_list(value)
+
+
+def _raw_procs(meta):
+    """
+    :return: {proc name: proc section of the lain.yaml}, named the way
+             LainConf._load_procs names them
+    """
+    procs = {}
+    for key, value in meta.iteritems():
+        if not is_section(key, Proc) or not isinstance(value, dict):
+            continue
+        parts = key.split('.')
+        if parts[0] == 'service' and len(parts) == 2:
+            procs[parts[1]] = value
+            procs['portal-%s' % parts[1]] = value.get('portal') or {}
+        else:
+            procs[parts[1] if len(parts) > 1 else parts[0]] = value
+    return procs
+
+
+def _volumes(meta, raw):
+    # 和 Proc.load 一样：persistent_dirs 优先，路径都基于 /lain/app 规范化
+    volumes = []
+    for volume in _as_list(meta.get('persistent_dirs')) or _as_list(meta.get('volumes')):
+        if isinstance(volume, dict):
+            if not volume:
+                continue
+            volume = volume.keys()[0]
+        volumes.append(lain_based_path(volume))
+    # lua 不处理 logs
+    if raw.get('logs'):
+        volumes.append('/lain/logs')
+    return volumes
+
+
+def _to_proc(name, meta, default_image, raw):
+    proc = Proc()
+    proc.name = meta.get('name', name)
+    proc.type = LUA_PROC_TYPES[meta['type']]
+    proc.image = meta.get('image') or default_image
+    proc.entrypoint = _exec_form(meta.get('entrypoint'))
+    proc.cmd = _exec_form(meta.get('cmd'))
+    proc.num_instances = meta.get('num_instances', 1)
+    proc.cpu = meta.get('cpu', 0)
+    proc.memory = meta.get('memory', '32m')
+    port_meta = meta.get('port')
+    if port_meta and port_meta.get('port'):
+        port = Port()
+        port.port = int(port_meta['port'])
+        port.type = LUA_SOCKET_TYPES[port_meta.get('type', 0)]
+        proc.port = {port.port: port}
+    else:
+        proc.port = {}
+    proc.mountpoint = _as_list(meta.get('mountpoint'))
+    proc.env = _as_list(meta.get('env'))
+    proc.volumes = _volumes(meta, raw)
+    proc.user = meta.get('user', '')
+    proc.working_dir = meta.get('workdir', '')
+    if proc.type == ProcType.portal:
+        proc.service_name = meta.get('service_name', '')
+        # lua 把字符串包成了 list，LainConf 保留原样
+        proc.allow_clients = raw.get('allow_clients', '**')
+    return proc
+
+
+def load(meta_yaml, meta_version, default_image, pool=None, **cluster_config):
+    """
+    Same signature as LainConf.load, returns a LainConf filled by the lua parser
+    """
+    conf = LainConf()
+    meta = guarded_load(yaml_stream(meta_yaml), conf.limits,
+                        Proc.SECTION_KEYWORDS._member_names_)
+    completed = (pool or default_pool()).complete(meta, meta.get('appname'), meta_version)
+
+    conf.meta_version = meta_version
+    conf.appname = completed['appname']
+    default_image = default_image or gen_image_name(
+        conf.appname, 'release', meta_version=meta_version,
+        docker_reg=cluster_config.get('registry', PRIVATE_REGISTRY))
+    raw_procs = _raw_procs(meta)
+    conf.procs = dict((name, _to_proc(name, m, default_image, raw_procs.get(m.get('name', name), {})))
+                      for name, m in (completed.get('procs') or {}).iteritems())
+    for attr, section_class in (('build', Build), ('release', Release),
+                                ('test', Test), ('publish', Publish)):
+        section = section_class()
+        section_meta = completed.get(attr)
+        if isinstance(section_meta, dict):
+            # lua 用 "" 表示缺省的字段
+            section.load(dict((k, v) for k, v in section_meta.iteritems() if v != ''))
+        setattr(conf, attr, section)
+    conf.notify = completed.get('notify') or {}
+    if completed.get('use_services'):
+        conf.use_services = conf._load_use_services(completed['use_services'])
+    if completed.get('use_resources'):
+        conf.use_resources = conf._load_use_resources(completed['use_resources'])
+    return conf
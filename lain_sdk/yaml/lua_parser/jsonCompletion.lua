@@ -1,4 +1,5 @@
-json = require "ljson"
+-- ljson is only needed when reading json files, loaded lazily by jsonComplete
+json = nil
 ---------------------------------------------------------------------------------------------------------------
 -- Enum for SocketType & ProcType
 SocketType={tcp=0,udp=1}
@@ -178,7 +179,20 @@ function jsonComplete(fileName)
 
 	--data = yaml.load(str)
 	---------------------------------------------------------------------------------input is json or yaml~
-	data = json.decode(str)
+	json = json or require "ljson"
+	data = completeData(json.decode(str))
+	ans = json.encode(data)
+	print(ans)
+	-- return json.decode(data)
+	return data
+end
+
+---------------------------------------------------------------------------------------------------------------
+--- input : decoded lain conf table , output : completed table
+---------------------------------------------------------------------------------------------------------------
+
+function completeData(input)
+	data = input
 
 	---------------------------------------------------------------------------------------------------------------
 	-- appname must be in yaml
@@ -278,7 +292,7 @@ function jsonComplete(fileName)
 
 	typekey = {}
 	for k,v in pairs(data) do
-		if k ~= "appname" and k ~= "build" and k ~= "release" and k ~= "test" and k ~= "notify" and k ~= "use_serivces" and k~="secret_files" then
+		if k ~= "appname" and k ~= "build" and k ~= "release" and k ~= "test" and k ~= "notify" and k ~= "use_services" and k ~= "use_resources" and k ~= "publish" and k ~= "apptype" and k~="secret_files" then
 			table.insert(typekey,k)
 			--print(k)
 		end
@@ -490,12 +504,22 @@ function jsonComplete(fileName)
 	--checkNoMoreConf(data)
 	checkProcsValid(data)
 	checkProtalName(data)
-	ans = json.encode(data)
-	print(ans)
-	-- return json.decode(data)
 	return data
 end
 
+---------------------------------------------------------------------------------------------------------------
+--- input : globals lain_meta (decoded table), repo_name, meta_version , output : completed table
+---------------------------------------------------------------------------------------------------------------
+function getDataFromGlobals()
+	tab = completeData(lain_meta)
+	tab['repo_name'] = repo_name
+	tab['meta_version'] = meta_version
+
+	return tab
+end
+
 --return jsonComplete(fileName)
 --return jsonComplete("test_json/2.json")
-return getData(fileName, repo_name, meta_version)
+if fileName ~= nil then
+	return getData(fileName, repo_name, meta_version)
+end
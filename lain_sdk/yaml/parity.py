@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parity and throughput harness between the python and the lua parser
+
+    python -m lain_sdk.yaml.parity [--generated N] [--repeat N] [path ...]
+
+Without paths it runs over lua_parser/test/*.yaml and test_json/*.json.
+Every document is loaded by both backends, field level divergences in
+procs, ports, build and release sections are reported, then the per
+document throughput of each backend is measured.
+"""
+
+import glob
+import json
+import optparse
+import os
+import random
+import sys
+import time
+
+from .backend import load_lain_conf
+from .lua_backend import LUA_AVAILABLE, LUA_PARSER_DIR
+
+META_VERSION = '1428553798-7142797e64bb7b4d057455ef13de6be156ae81cc'
+PROC_FIELDS = ('type', 'image', 'entrypoint', 'cmd', 'num_instances', 'cpu',
+               'memory', 'port', 'mountpoint', 'env', 'volumes', 'user',
+               'working_dir', 'service_name', 'allow_clients')
+
+
+def corpus_paths():
+    paths = glob.glob(os.path.join(LUA_PARSER_DIR, 'test', '*.yaml'))
+    paths += glob.glob(os.path.join(LUA_PARSER_DIR, 'test_json', '*.json'))
+    return sorted(paths)
+
+
+def generate_documents(count, seed=0):
+    """
+    :return: [(name, meta_yaml)] of random but valid lain.yaml documents
+    """
+    rng = random.Random(seed)
+    docs = []
+    for i in range(count):
+        meta = {
+            'appname': 'gen%d' % i,
+            'build': {
+                'base': rng.choice(['golang', 'centos', 'ubuntu']),
+                'script': ['make %d' % n for n in range(rng.randint(0, 3))],
+            },
+            'release': {
+                'dest_base': 'ubuntu',
+                'copy': [{'src': 'bin%d' % n, 'dest': '/usr/bin/bin%d' % n}
+                         for n in range(rng.randint(0, 2))],
+            },
+        }
+        for n in range(rng.randint(1, 4)):
+            kind = rng.choice(['worker', 'web', 'service', 'proc'])
+            proc = {
+                'cmd': 'run %d' % n,
+                'num_instances': rng.randint(1, 5),
+                'memory': '%dm' % rng.choice([32, 64, 128]),
+                'env': ['N=%d' % n],
+            }
+            if kind == 'web':
+                name = 'web' if n == 0 else 'web.w%d' % n
+                proc['port'] = rng.choice([80, 8080])
+                if n != 0:
+                    proc['mountpoint'] = ['w%d.example.com' % n]
+            elif kind == 'service':
+                name = 'service.s%d' % n
+                proc['port'] = 1000 + n
+                proc['portal'] = {'cmd': 'proxy', 'allow_clients': '**'}
+            elif kind == 'proc':
+                name = 'proc.p%d' % n
+                proc['type'] = 'worker'
+            else:
+                name = 'worker.w%d' % n
+            meta[name] = proc
+        docs.append(('generated-%d' % i, json.dumps(meta)))
+    return docs
+
+
+def _plain(value):
+    if isinstance(value, dict):
+        return sorted((k, _plain(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if hasattr(value, 'port') and hasattr(value, 'type'):
+        return (value.port, value.type.name)
+    if hasattr(value, 'name') and hasattr(value, 'value'):
+        return value.name
+    return value
+
+
+def conf_fields(conf):
+    """
+    Flatten the comparable parts of a LainConf to {path: value}
+    """
+    fields = {'appname': conf.appname}
+    for name, proc in conf.procs.iteritems():
+        for f in PROC_FIELDS:
+            fields['procs.%s.%s' % (name, f)] = _plain(getattr(proc, f))
+    build = conf.build
+    fields['build.base'] = build.base
+    fields['build.script'] = build.script
+    fields['build.prepare.script'] = build.prepare.script if build.prepare else None
+    fields['build.prepare.keep'] = build.prepare.keep if build.prepare else None
+    fields['release.script'] = conf.release.script
+    fields['release.dest_base'] = conf.release.dest_base
+    fields['release.copy'] = _plain(conf.release.copy)
+    fields['test.script'] = conf.test.script
+    fields['publish.script'] = conf.publish.script
+    return fields
+
+
+def _load(meta_yaml, backend):
+    try:
+        return load_lain_conf(meta_yaml, META_VERSION, None, backend=backend), None
+    except Exception as e:
+        return None, str(e).split('\n')[0]
+
+
+def compare(meta_yaml):
+    """
+    :return: [(path, python_value, lua_value)], empty when both parsers agree
+    """
+    py_conf, py_error = _load(meta_yaml, 'python')
+    lua_conf, lua_error = _load(meta_yaml, 'lua')
+    if py_error or lua_error:
+        if py_error and lua_error:
+            return []
+        return [('<load>', py_error or 'ok', lua_error or 'ok')]
+    py_fields, lua_fields = conf_fields(py_conf), conf_fields(lua_conf)
+    divergences = []
+    for path in sorted(set(py_fields) | set(lua_fields)):
+        py_value, lua_value = py_fields.get(path), lua_fields.get(path)
+        if py_value != lua_value:
+            divergences.append((path, py_value, lua_value))
+    return divergences
+
+
+def throughput(backend, docs, repeat=3):
+    """
+    :return: documents per second loaded by backend, failed loads included
+    """
+    start = time.time()
+    for _ in range(repeat):
+        for _, meta_yaml in docs:
+            _load(meta_yaml, backend)
+    elapsed = time.time() - start
+    return len(docs) * repeat / elapsed if elapsed else float('inf')
+
+
+def run(docs, repeat=3, out=sys.stdout):
+    if not LUA_AVAILABLE:
+        out.write('lupa is not installed, nothing to compare\n')
+        return 1
+    diverged = 0
+    for name, meta_yaml in docs:
+        divergences = compare(meta_yaml)
+        if divergences:
+            diverged += 1
+            out.write('%s: %d divergences\n' % (name, len(divergences)))
+            for path, py_value, lua_value in divergences:
+                out.write('    %s\n        python: %r\n        lua:    %r\n' % (path, py_value, lua_value))
+    out.write('%d/%d documents diverged\n' % (diverged, len(docs)))
+    for backend in ('python', 'lua'):
+        out.write('%-6s %8.1f docs/s\n' % (backend, throughput(backend, docs, repeat)))
+    return 1 if diverged else 0
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [path ...]')
+    parser.add_option('--generated', type='int', default=50,
+                      help="number of generated documents to add, default 50")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="load every document N times when measuring throughput")
+    options, paths = parser.parse_args(argv)
+    docs = []
+    for path in paths or corpus_paths():
+        with open(path) as f:
+            docs.append((os.path.relpath(path), f.read()))
+    docs += generate_documents(options.generated)
+    return run(docs, options.repeat)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
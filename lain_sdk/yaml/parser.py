@@ -3,15 +3,19 @@
 
 import re
 import yaml
-from jinja2 import Template
+from jinja2 import Environment, meta as jinja_meta
+from jinja2.utils import LRUCache
 import json
 import copy
 import os
+import multiprocessing
 from enum import Enum
 from os.path import abspath
 
 from ..mydocker import gen_image_name
 from .conf import PRIVATE_REGISTRY, DOMAIN, DOCKER_APP_ROOT
+from .util import yaml_stream
+from .guard import guarded_load, DEFAULT_LOAD_LIMITS
 from ..util import lain_based_path
 
 SOCKET_TYPES = 'tcp udp'
@@ -27,6 +31,14 @@ MIN_SETUP_TIME = 0
 MAX_SETUP_TIME = 120
 MIN_KILL_TIMEOUT = 10
 MAX_KILL_TIMEOUT = 60
+TEMPLATE_SYNTAX = ('{{', '{%', '{#')
+TEMPLATE_CACHE_SIZE = 1024
+RENDER_PLAN_CACHE_SIZE = 128
+
+# resource 模板渲染共用一个 jinja Environment，编译好的模板按源码缓存
+JINJA_ENV = Environment()
+_template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+_render_plan_cache = LRUCache(RENDER_PLAN_CACHE_SIZE)
 
 
 def restrict_value(v, minv, maxv):
@@ -121,6 +133,15 @@ class Port:
         else:
             raise Exception('not supported port desc %s' % (meta, ))
 
+    def __eq__(self, other):
+        if not isinstance(other, Port):
+            return NotImplemented
+        return self.port == other.port and self.type == other.type
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
 
 class Proc:
     SECTION_KEYWORDS = Enum('SECTION_KEYWORDS', PROC_TYPES + " proc service")
@@ -179,11 +200,11 @@ class Proc:
         self.cmd = self.__to_exec_form(meta_cmd)
         self.user = meta.get('user', '')
         self.working_dir = meta.get('workdir') or meta.get('working_dir', '')
-        dns_search_meta = meta.get('dns_search', [])
+        # 复制一份再修改，不改动传入的 meta
+        self.dns_search = list(meta.get('dns_search', []))
         app_dns_search = "%s.lain"%get_app_domain(appname)
-        if app_dns_search not in dns_search_meta:
-            dns_search_meta.append(app_dns_search)
-        self.dns_search = dns_search_meta
+        if app_dns_search not in self.dns_search:
+            self.dns_search.append(app_dns_search)
         self.cpu = meta.get('cpu', 0)
         self.memory = meta.get('memory', '32m')
         self.num_instances = meta.get('num_instances', 1)
@@ -233,16 +254,16 @@ class Proc:
                 if not mountpoint_meta or not isinstance(mountpoint_meta, list):
                     self.mountpoint = default_mountpoints
                 else:
+                    self.mountpoint = list(mountpoint_meta)
                     for mp in default_mountpoints:
-                        if mp not in mountpoint_meta:
-                            mountpoint_meta.append(mp)
-                    self.mountpoint = mountpoint_meta
+                        if mp not in self.mountpoint:
+                            self.mountpoint.append(mp)
             else:
                 # ProcName != 'web' 则必须有另外的 mountpoint
                 if not mountpoint_meta or not isinstance(mountpoint_meta, list):
                     raise Exception('proc (type is web but name is not web) should have own mountpoint.\nkeyword: %s\nmeta: %s' % (keyword, meta))
                 else:
-                    self.mountpoint = mountpoint_meta
+                    self.mountpoint = list(mountpoint_meta)
             to_remove = []
             for mp in self.mountpoint:
                 if mp.startswith('/'):
@@ -490,9 +511,23 @@ class LainConf:
     notify = {}
     use_services = {}
     use_resources = {}
+    limits = DEFAULT_LOAD_LIMITS
 
     def load(self, meta_yaml, meta_version, default_image, **cluster_config):
-        meta = yaml.safe_load(meta_yaml)
+        '''
+        meta_yaml maybe:
+            yaml text (str/unicode)
+            file object or mmap, read as a stream
+            bytearray or memoryview
+        '''
+        meta = guarded_load(yaml_stream(meta_yaml), self.limits,
+                            Proc.SECTION_KEYWORDS._member_names_)
+        self.load_meta(meta, meta_version, default_image, **cluster_config)
+
+    def load_meta(self, meta, meta_version, default_image, **cluster_config):
+        '''
+        load an already decoded lain.yaml, meta is not modified
+        '''
         self.meta_version = meta_version
         self.appname = meta.get('appname', None)
         if self.appname is None:
@@ -514,6 +549,10 @@ class LainConf:
         if use_resources_meta:
             self.use_resources = self._load_use_resources(use_resources_meta)
 
+    def load_file(self, path, meta_version, default_image, **cluster_config):
+        with open(path, 'rb') as f:
+            self.load(f, meta_version, default_image, **cluster_config)
+
     def _load_procs(self, meta, appname, meta_version, default_image, **cluster_config):
         _procs = {}
         def _proc_load(key, meta, **cluster_config):
@@ -564,30 +603,35 @@ class LainConf:
         else:
             return {}
 
+    # 每次 load 都生成新的 section 对象，类属性上的默认对象是所有 LainConf 共享的
     def _load_build(self, meta):
         meta = meta.get('build', None)
         if meta is None:
             raise Exception("no build section in lain.yaml")
-        self.build.load(meta)
-        return self.build
+        build = Build()
+        build.load(meta)
+        return build
 
     def _load_release(self, meta):
         meta = meta.get('release', None)
+        release = Release()
         if meta is not None:
-            self.release.load(meta)
-        return self.release
+            release.load(meta)
+        return release
 
     def _load_test(self, meta):
         meta = meta.get('test', None)
+        test = Test()
         if meta is not None:
-            self.test.load(meta)
-        return self.test
+            test.load(meta)
+        return test
 
     def _load_publish(self, meta):
         meta = meta.get('publish', None)
+        publish = Publish()
         if meta is not None:
-            self.publish.load(meta)
-        return self.publish
+            publish.load(meta)
+        return publish
 
     def _load_notify(self, meta):
         meta = meta.get('notify', None)
@@ -612,32 +656,147 @@ def render_resource_instance_meta(
             resource_appname, resource_meta_version, resource_meta_template,
             client_appname, context, registry, domains):
     # 用 use_resources 里的变量渲染 resource 模板
-    instance_yaml = render_instance_yaml(resource_meta_template, context)
-    instance_meta = yaml.dump(instance_yaml, default_flow_style=False)
-    resource_config = LainConf()
-    resource_config.load(
-        instance_meta, resource_meta_version, None,
-        registry=registry, domains=domains
-    )
+    instance_meta, _ = _render_resource_instance(
+        get_render_plan(resource_meta_template), resource_appname,
+        resource_meta_version, client_appname, context, registry, domains)
+    return instance_meta
+
+def render_resource_instance_metas(
+            resource_appname, resource_meta_version, resource_meta_template,
+            clients, registry, domains, processes=None):
+    """
+    Render one resource template for many client apps
+
+    The template is parsed and compiled into a RenderPlan once, with
+    `processes` > 1 the instances are rendered in a process pool.
+
+    :param clients: [(client_appname, context)]
+    :return: [(instance_meta, instance_config)] in the order of clients,
+             instance_config is the LainConf of the instance
+    """
+    if not processes or processes <= 1 or len(clients) <= 1:
+        plan = get_render_plan(resource_meta_template)
+        return [_render_resource_instance(
+                    plan, resource_appname, resource_meta_version,
+                    client_appname, context, registry, domains)
+                for client_appname, context in clients]
+    args = (resource_meta_template, resource_appname, resource_meta_version, registry, domains)
+    pool = multiprocessing.Pool(processes, _init_batch_render, args)
+    try:
+        return pool.map(_batch_render, clients)
+    finally:
+        pool.terminate()
+
+_batch_render_args = None
+
+def _init_batch_render(resource_meta_template, *args):
+    # 进程池里每个 worker 只编译一次模板，编译好的 jinja 模板不能 pickle
+    global _batch_render_args
+    _batch_render_args = (get_render_plan(resource_meta_template), ) + args
+
+def _batch_render(client):
+    plan, resource_appname, resource_meta_version, registry, domains = _batch_render_args
+    client_appname, context = client
+    return _render_resource_instance(
+        plan, resource_appname, resource_meta_version,
+        client_appname, context, registry, domains)
+
+def _render_resource_instance(
+            plan, resource_appname, resource_meta_version,
+            client_appname, context, registry, domains):
+    return build_resource_instance(
+        plan.render(context), resource_appname, resource_meta_version,
+        client_appname, registry, domains)
+
+def build_resource_instance(
+            instance_yaml, resource_appname, resource_meta_version,
+            client_appname, registry, domains):
+    """
+    Turn a rendered template into (instance_meta, instance_config)
+    """
+    instance_yaml = dict(instance_yaml)
     # 将 appname 替换成 resource instance appname
-    instance_appname = resource_instance_name(resource_appname, client_appname)
-    instance_yaml['appname'] = instance_appname
+    instance_yaml['appname'] = resource_instance_name(resource_appname, client_appname)
     # 将 apptype 的 key 删除
     instance_yaml.pop('apptype', None)
-    # return 最终的 yaml dump
-    return yaml.dump(instance_yaml, default_flow_style=False)
+    instance_meta = yaml.dump(instance_yaml, default_flow_style=False)
+    # 用最终的 yaml 校验一遍，同时得到 instance 的 LainConf
+    default_image = gen_image_name(resource_appname, 'release',
+                                   meta_version=resource_meta_version,
+                                   docker_reg=registry)
+    instance_config = LainConf()
+    instance_config.load(
+        instance_meta, resource_meta_version, default_image,
+        registry=registry, domains=domains
+    )
+    return instance_meta, instance_config
 
-def render_instance_yaml(resource_meta_template, context):
-    instance_yaml = yaml.safe_load(resource_meta_template)
-    for key in instance_yaml:
-        if type(instance_yaml[key]) == dict:
-            iterate_parse_yaml_dict(instance_yaml[key], context)
-        elif type(instance_yaml[key]) == list:
-            iterate_parse_yaml_list(instance_yaml[key], context)
-        else:
-            instance_yaml[key] = get_jinja_render_value(instance_yaml[key], context)
-    return instance_yaml
+def load_resource_template(resource_meta_template):
+    return guarded_load(resource_meta_template, LainConf.limits,
+                        Proc.SECTION_KEYWORDS._member_names_)
 
+def get_render_plan(resource_meta_template):
+    plan = _render_plan_cache.get(resource_meta_template)
+    if plan is None:
+        plan = RenderPlan(load_resource_template(resource_meta_template))
+        _render_plan_cache[resource_meta_template] = plan
+    return plan
+
+def render_instance_yaml(resource_meta_template, context):
+    # 调用方可能修改结果，不能和缓存的 plan 共享子树
+    return copy.deepcopy(get_render_plan(resource_meta_template).render(context))
+
+def render_parsed_instance_yaml(template_yaml, context):
+    return copy.deepcopy(RenderPlan(template_yaml).render(context))
+
+
+class RenderPlan(object):
+    """
+    A resource template compiled for rendering
+
+    `leaves` are the key paths of the values containing template syntax
+    with their compiled templates, `base` is the template with every
+    other value already converted, `variables` are the context names
+    referenced by the leaves. A render only evaluates the leaves
+    and copies the containers on their paths; everything else in the
+    result is shared with `base` by reference and must not be mutated,
+    except the top level dict which is always a fresh copy.
+    """
+
+    def __init__(self, template_yaml):
+        self.leaves = []
+        self.variables = set()
+        self.base = self._compile(template_yaml, ())
+
+    def _compile(self, node, path):
+        if type(node) == dict:
+            return dict((k, self._compile(v, path + (k, ))) for k, v in node.iteritems())
+        if type(node) == list:
+            return [self._compile(v, path + (i, )) for i, v in enumerate(node)]
+        if path and is_template(node):
+            self.leaves.append((path, compile_template(node)))
+            self.variables |= jinja_meta.find_undeclared_variables(JINJA_ENV.parse(node))
+            return node
+        return get_jinja_render_value(node, {}) if path else node
+
+    def render(self, context):
+        root = dict(self.base)
+        copied = {(): root}
+        for path, template in self.leaves:
+            parent = root
+            for i in range(1, len(path)):
+                prefix = path[:i]
+                container = copied.get(prefix)
+                if container is None:
+                    container = copy.copy(parent[path[i - 1]])
+                    parent[path[i - 1]] = container
+                    copied[prefix] = container
+                parent = container
+            parent[path[-1]] = _int_or_str(template.render(**context).encode('utf-8'))
+        return root
+
+
+# 以下两个函数保留给直接渲染 yaml 对象的调用方，会原地修改传入的对象
 def iterate_parse_yaml_dict(dict_yaml, context):
     for key in dict_yaml:
         if type(dict_yaml[key]) == dict:
@@ -656,11 +815,26 @@ def iterate_parse_yaml_list(list_yaml, context):
         else:
             list_yaml[index] = get_jinja_render_value(list_yaml[index], context)
 
-def get_jinja_render_value(value, context):
-    template = Template(str(value))
-    update_value = str(template.render(**context))
+def is_template(value):
+    return isinstance(value, basestring) and any(t in value for t in TEMPLATE_SYNTAX)
+
+def compile_template(source):
+    template = _template_cache.get(source)
+    if template is None:
+        template = JINJA_ENV.from_string(source)
+        _template_cache[source] = template
+    return template
+
+def _int_or_str(value):
     try:
-        update_value = int(update_value)
+        return int(value)
     except Exception:
-        pass
-    return update_value
+        return value
+
+def get_jinja_render_value(value, context):
+    # 非字符串的值（int, bool, None 等）保持原类型
+    if not isinstance(value, basestring):
+        return value
+    if is_template(value):
+        value = compile_template(value).render(**context).encode('utf-8')
+    return _int_or_str(value)
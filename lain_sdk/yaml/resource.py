@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+
+from jinja2.utils import LRUCache
+
+from .parser import (render_resource_instance_meta, get_render_plan,
+                     build_resource_instance)
+
+DEFAULT_CACHE_SIZE = 1024
+
+InstanceSpec = namedtuple('InstanceSpec', [
+    'resource_appname', 'client_appname', 'meta_version',
+    'instance_meta', 'instance_config'])
+
+
+def resource_instance_key(resource_appname, resource_meta_version, resource_meta_template,
+                          client_appname, context, registry, domains):
+    """
+    Digest of every input of render_resource_instance_meta
+    """
+    payload = json.dumps(
+        [resource_appname, resource_meta_version, resource_meta_template,
+         client_appname, context, registry, domains],
+        sort_keys=True, default=repr)
+    return hashlib.sha1(payload).hexdigest()
+
+
+class ResourceInstanceCache(object):
+    """
+    Cache of rendered resource instance metas
+
+    Rendered metas are kept in a LRU of `maxsize` entries; with `cache_dir`
+    they are also written to `<cache_dir>/<key>.yaml`, so a new process
+    (or an entry evicted from memory) does not have to render again.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._memory = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self._memory),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+        }
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, '%s.yaml' % key)
+
+    def get(self, key):
+        instance_meta = self._memory.get(key)
+        if instance_meta is not None:
+            with self._lock:
+                self.hits += 1
+            return instance_meta
+        if self.cache_dir:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    instance_meta = f.read()
+            except IOError:
+                pass
+            else:
+                self._memory[key] = instance_meta
+                with self._lock:
+                    self.disk_hits += 1
+                return instance_meta
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, instance_meta):
+        self._memory[key] = instance_meta
+        if self.cache_dir:
+            # 先写临时文件再 rename，其他进程不会读到写了一半的文件
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(instance_meta)
+                os.rename(tmp, self._disk_path(key))
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+    def clear(self):
+        self._memory.clear()
+        if self.cache_dir:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.yaml'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def render_resource_instance_meta(
+                self, resource_appname, resource_meta_version, resource_meta_template,
+                client_appname, context, registry, domains):
+        """
+        Same as parser.render_resource_instance_meta, but rendered only once
+        """
+        key = resource_instance_key(
+            resource_appname, resource_meta_version, resource_meta_template,
+            client_appname, context, registry, domains)
+        instance_meta = self.get(key)
+        if instance_meta is None:
+            instance_meta = render_resource_instance_meta(
+                resource_appname, resource_meta_version, resource_meta_template,
+                client_appname, context, registry, domains)
+            self.put(key, instance_meta)
+        return instance_meta
+
+
+class ResourceDependencies(object):
+    """
+    Which client apps use which resources, and what their instances rendered to
+
+    Clients are registered with the `use_resources` of their LainConf. When
+    a resource publishes a new template only its clients are rendered, and
+    clients whose context agrees on every variable the template references
+    share one render. An instance is reported as changed when its rendered
+    template, the resource meta_version, the registry or the domains differ
+    from the previous publish (or it has none yet); only those instances
+    are dumped and loaded into a LainConf.
+    """
+
+    def __init__(self):
+        self._clients = {}     # resource_appname -> {client_appname: context}
+        # (resource_appname, client_appname) -> (rendered template, meta_version, registry, domains)
+        self._rendered = {}
+
+    def set_client(self, client_appname, use_resources):
+        """
+        :param use_resources: LainConf.use_resources of the client app
+        """
+        for resource_appname in self._clients.keys():
+            if resource_appname not in use_resources:
+                self._forget(resource_appname, client_appname)
+        for resource_appname, v in use_resources.iteritems():
+            self._clients.setdefault(resource_appname, {})[client_appname] = v.get('context') or {}
+
+    def remove_client(self, client_appname):
+        self.set_client(client_appname, {})
+
+    def _forget(self, resource_appname, client_appname):
+        clients = self._clients.get(resource_appname, {})
+        clients.pop(client_appname, None)
+        if not clients:
+            self._clients.pop(resource_appname, None)
+        self._rendered.pop((resource_appname, client_appname), None)
+
+    def clients_of(self, resource_appname):
+        return sorted(self._clients.get(resource_appname, {}))
+
+    def affected(self, resource_appname, resource_meta_version, resource_meta_template,
+                 registry, domains):
+        """
+        :return: [(client_appname, rendered template)] of the instances which
+                 would change if resource_meta_template was published
+        """
+        # 模板没变但版本、registry 或 domains 变了，实例的 meta 也会变
+        published = (resource_meta_version, registry, list(domains or []))
+        plan = get_render_plan(resource_meta_template)
+        renders = {}
+        affected = []
+        for client_appname, context in sorted(self._clients.get(resource_appname, {}).iteritems()):
+            # 缺省的变量和值为 None 的变量渲染结果不同，要区分开
+            group = json.dumps([(k, k in context, context.get(k)) for k in sorted(plan.variables)],
+                               default=repr)
+            instance_yaml = renders.get(group)
+            if instance_yaml is None:
+                instance_yaml = renders[group] = plan.render(context)
+            if self._rendered.get((resource_appname, client_appname)) != (instance_yaml,) + published:
+                affected.append((client_appname, instance_yaml))
+        return affected
+
+    def publish(self, resource_appname, resource_meta_version, resource_meta_template,
+                registry, domains):
+        """
+        Record a new resource template and render the instances it changes
+
+        :return: [InstanceSpec] of the changed instances
+        """
+        changed = []
+        published = (resource_meta_version, registry, list(domains or []))
+        for client_appname, instance_yaml in self.affected(
+                resource_appname, resource_meta_version, resource_meta_template, registry, domains):
+            instance_meta, instance_config = build_resource_instance(
+                instance_yaml, resource_appname, resource_meta_version,
+                client_appname, registry, domains)
+            self._rendered[(resource_appname, client_appname)] = (instance_yaml,) + published
+            changed.append(InstanceSpec(resource_appname, client_appname, resource_meta_version,
+                                        instance_meta, instance_config))
+        return changed
@@ -6,9 +6,38 @@ import os
 import yaml
 from ..util import get_cfd
 
+
+class _BufferReader(object):
+    # 按块读取 bytearray/memoryview，避免整体复制一份 str
+
+    def __init__(self, buf):
+        self._view = memoryview(buf)
+        self._pos = 0
+
+    def read(self, size=-1):
+        total = len(self._view)
+        end = total if size < 0 else min(self._pos + size, total)
+        chunk = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return chunk
+
+
+def yaml_stream(source):
+    """
+    Adapt a lain.yaml source so yaml.safe_load can read it directly
+
+    str/unicode, file objects and mmap are passed through as is (PyYAML
+    reads streams chunk by chunk), bytearray/memoryview are wrapped in a
+    reader that slices the buffer instead of copying it whole.
+    """
+    if isinstance(source, (bytearray, memoryview)):
+        return _BufferReader(source)
+    return source
+
+
 def load_yaml(path):
     with open(path) as f:
-        return yaml.safe_load(f.read())
+        return yaml.safe_load(f)
 
 def write_yaml(path, dic):
     with open(path, 'w') as f:
@@ -1,11 +1,156 @@
 # -*- coding: utf-8 -*-
 
+import re
+
 import jsonschema
 from .schema import schema
+from .codegen import compile_validator
+from ..guard import guarded_load
+from ..parser import LainConf, Proc
+from ..util import yaml_stream
+
+# meta schema 的校验只在 import 时做一次
+Validator = jsonschema.validators.validator_for(schema)
+Validator.check_schema(schema)
+
+
+class SchemaValidator(object):
+    """
+    jsonschema validator of a (sub) schema, with the function generated by
+    codegen as fast path: jsonschema only runs to explain invalid data
+    """
+
+    def __init__(self, schema):
+        self.validator = Validator(schema)
+        self.is_valid = compile_validator(schema)
+
+    def iter_errors(self, data):
+        return self.validator.iter_errors(data)
+
+    def validate(self, data, all_errors=False, prefix=()):
+        """
+        :param prefix: key path of data in the lain.yaml, used in error paths
+        """
+        if self.is_valid(data):
+            return True, 'ok'
+        if all_errors:
+            errors = sorted(self.iter_errors(data), key=lambda e: list(e.absolute_path))
+            if not errors:
+                return True, 'ok'
+            return False, '\n'.join('%s: %s' % (error_path(e, prefix) or '<root>', e.message)
+                                    for e in errors)
+        try:
+            self.validator.validate(data)
+            return True, 'ok'
+        except Exception as e:
+            return False, str(e)
+
+
+_root = SchemaValidator(schema)
+validator = _root.validator
+# 由 schema 生成的专用校验函数，只判断是否合法
+is_valid = _root.is_valid
+# 子 schema 的 validator 用到时才编译
+_sub_validators = {}
+
+
+def iter_errors(source_data):
+    """
+    Yield every jsonschema.ValidationError of source_data
+    """
+    return _root.iter_errors(source_data)
+
+
+def error_path(error, prefix=()):
+    return '.'.join(str(p) for p in tuple(prefix) + tuple(error.absolute_path))
+
+
+def validate(source_data, all_errors=False):
+    """
+    :return: (valid, msg), with `all_errors` msg lists every error as
+             `key.path: message` instead of the first error only
+    """
+    return _root.validate(source_data, all_errors)
 
-def validate(source_data):
+
+def _sub_validator(key, sub_schema):
+    sub_validator = _sub_validators.get(key)
+    if sub_validator is None:
+        sub_validator = _sub_validators[key] = SchemaValidator(sub_schema)
+    return sub_validator
+
+
+def proc_schema(key):
+    """
+    :return: (pattern, schema) of the proc section `key`, such as web.foo
+    """
+    for pattern, sub_schema in schema['patternProperties'].iteritems():
+        if re.search(pattern, key):
+            return pattern, sub_schema
+    raise Exception('invalid proc key %s' % key)
+
+
+def validate_section(name, data, all_errors=False):
+    """
+    Validate a top level section other than procs, such as build or release
+    """
+    if name not in schema['properties']:
+        raise Exception('unknown section %s' % name)
+    return _sub_validator(('section', name), schema['properties'][name]).validate(
+        data, all_errors, (name, ))
+
+
+def validate_proc(key, data, all_errors=False):
+    """
+    Validate the whole mapping of the proc section `key`
+    """
+    pattern, sub_schema = proc_schema(key)
+    return _sub_validator(('proc', pattern), sub_schema).validate(data, all_errors, (key, ))
+
+
+def validate_proc_patch(key, payload, all_errors=False):
+    """
+    Validate only the fields of a patch to the proc section `key`, as
+    applied by Proc.patch; required fields are not checked
+    """
+    pattern, sub_schema = proc_schema(key)
+    properties = sub_schema['properties']
+    messages = []
+    for field in sorted(payload):
+        if field not in properties:
+            valid, msg = False, 'Additional properties are not allowed (%r was unexpected)' % field
+            if all_errors:
+                msg = '%s.%s: %s' % (key, field, msg)
+        else:
+            valid, msg = _sub_validator(('field', pattern, field), properties[field]).validate(
+                payload[field], all_errors, (key, field))
+        if not valid:
+            if not all_errors:
+                return False, msg
+            messages.append(msg)
+    if messages:
+        return False, '\n'.join(messages)
+    return True, 'ok'
+
+
+def validate_and_load(meta_yaml, meta_version, default_image, **cluster_config):
+    """
+    Decode meta_yaml once, validate the document and load the same
+    document into a LainConf; meta_yaml is anything LainConf.load takes
+
+    :return: (valid, msg, conf), conf is None unless valid
+    """
+    conf = LainConf()
+    try:
+        meta = guarded_load(yaml_stream(meta_yaml), conf.limits,
+                            Proc.SECTION_KEYWORDS._member_names_)
+    except Exception as e:
+        return False, str(e), None
+    valid, msg = validate(meta)
+    if not valid:
+        return False, msg, None
     try:
-        jsonschema.validate(source_data, schema)
-        return True, 'ok'
+        conf.load_meta(meta, meta_version, default_image, **cluster_config)
     except Exception as e:
-        return False, str(e)
+        return False, str(e), None
+    return True, 'ok', conf
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per call latency of lain.yaml validation
+
+    python -m lain_sdk.yaml.validator.benchmark [--number N] [path ...]
+
+Without paths it runs over lua_parser/test/*.yaml. Every document is
+validated N times by jsonschema.validate, which checks the schema and
+builds a validator on each call, by the cached jsonschema validator and
+by the function generated from the schema by codegen.
+"""
+
+import glob
+import optparse
+import os
+import sys
+import time
+
+import jsonschema
+import yaml
+
+from . import schema, validator, is_valid
+from ..lua_backend import LUA_PARSER_DIR
+
+
+def corpus_paths():
+    return sorted(glob.glob(os.path.join(LUA_PARSER_DIR, 'test', '*.yaml')))
+
+
+def load_documents(paths):
+    docs = []
+    for path in paths:
+        with open(path) as f:
+            data = yaml.safe_load(f)
+        if isinstance(data, dict):
+            docs.append(data)
+    return docs
+
+
+def _uncached(source_data):
+    try:
+        jsonschema.validate(source_data, schema)
+    except jsonschema.ValidationError:
+        pass
+
+
+def latency(func, docs, number):
+    """
+    :return: mean seconds per call of func over docs
+    """
+    start = time.time()
+    for _ in range(number):
+        for doc in docs:
+            func(doc)
+    return (time.time() - start) / (number * len(docs))
+
+
+def run(docs, number=100, out=sys.stdout):
+    out.write('%d documents, %d rounds\n' % (len(docs), number))
+    for name, func in (('jsonschema.validate', _uncached),
+                       ('cached validator', validator.is_valid),
+                       ('generated validator', is_valid)):
+        out.write('%-20s %10.1f us/call\n' % (name, latency(func, docs, number) * 1e6))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [path ...]')
+    parser.add_option('--number', type='int', default=100,
+                      help="validate every document N times, default 100")
+    options, paths = parser.parse_args(argv)
+    docs = load_documents(paths or corpus_paths())
+    if not docs:
+        parser.error('no lain.yaml to validate')
+    run(docs, options.number)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
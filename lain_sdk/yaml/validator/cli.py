@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Validate and parse every lain.yaml under some directories
+
+    lain_validate [-j N] [--json] [path ...]
+
+Paths may be directories, which are walked (hidden directories are
+skipped), or lain.yaml files. The files are checked in a process pool;
+every schema error is reported with its key path, and files which pass
+the schema are also loaded by LainConf. Exits 1 when any file fails.
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+
+from . import is_valid, iter_errors, error_path
+from ..guard import guarded_load
+from ..parser import LainConf, Proc
+
+LAIN_YAML = 'lain.yaml'
+# 只用来解析，不会真的用到
+META_VERSION = '1428553798-7142797e64bb7b4d057455ef13de6be156ae81cc'
+
+
+def find_lain_yamls(paths, name=LAIN_YAML):
+    found = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        if not os.path.isdir(path):
+            raise Exception('no such file or directory: %s' % path)
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            if name in files:
+                found.append(os.path.join(root, name))
+    return found
+
+
+def check_file(path):
+    """
+    :return: {'file': path, 'valid': bool, 'errors': [{'path': key path, 'message': msg}]}
+    """
+    result = {'file': path, 'valid': False, 'errors': []}
+    try:
+        with open(path, 'rb') as f:
+            meta_yaml = f.read()
+        meta = guarded_load(meta_yaml, LainConf.limits, Proc.SECTION_KEYWORDS._member_names_)
+    except Exception as e:
+        # yaml 的出错信息有多行，压成一行
+        result['errors'].append({'path': '', 'message': 'invalid yaml: %s' % ' '.join(str(e).split())})
+        return result
+    errors = [] if is_valid(meta) else sorted(iter_errors(meta), key=lambda e: list(e.absolute_path))
+    result['errors'] = [{'path': error_path(e), 'message': e.message} for e in errors]
+    if not errors:
+        try:
+            LainConf().load_meta(meta, META_VERSION, None)
+        except Exception as e:
+            result['errors'].append({'path': '', 'message': 'parse error: %s' % ' '.join(str(e).split())})
+    result['valid'] = not result['errors']
+    return result
+
+
+def check_files(paths, processes=None):
+    if processes == 1 or len(paths) <= 1:
+        return [check_file(path) for path in paths]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(check_file, paths, chunksize=8)
+    finally:
+        pool.terminate()
+
+
+def format_results(results):
+    lines = []
+    for result in results:
+        for error in result['errors']:
+            if error['path']:
+                lines.append('%s: %s: %s' % (result['file'], error['path'], error['message']))
+            else:
+                lines.append('%s: %s' % (result['file'], error['message']))
+    failed = len([r for r in results if not r['valid']])
+    lines.append('%d files checked, %d failed' % (len(results), failed))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None, out=sys.stdout):
+    parser = optparse.OptionParser(usage='%prog [options] [path ...]')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help="number of worker processes, default is the cpu count")
+    parser.add_option('--name', default=LAIN_YAML,
+                      help="file name to look for in directories, default is lain.yaml")
+    parser.add_option('--json', action='store_true', default=False,
+                      help="print the results as json")
+    options, paths = parser.parse_args(argv)
+    try:
+        files = find_lain_yamls(paths or [os.getcwd()], options.name)
+    except Exception as e:
+        parser.error(str(e))
+    results = check_files(files, options.jobs)
+    if options.json:
+        json.dump(results, out, indent=2, sort_keys=True)
+        out.write('\n')
+    else:
+        out.write(format_results(results))
+    return 0 if all(r['valid'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compile a draft 4 json schema into a specialized python function
+
+    python -m lain_sdk.yaml.validator.codegen    # print the generated source
+
+Every sub-schema becomes a function `x -> bool` with inlined type checks,
+precompiled regexes and early exits; shared sub-schemas are generated
+once. Only the keywords used by schema.py are supported, anything else
+raises NotImplementedError instead of being silently ignored. The
+decisions follow jsonschema 2.5.1: keywords only apply to instances of
+their type, bool is not an integer or a number, and `pattern` as well as
+`patternProperties` use re.search.
+"""
+
+import sys
+
+# 只起说明作用的关键字
+ANNOTATIONS = ('$schema', 'title', 'description')
+
+TYPE_CHECKS = {
+    'string': 'isinstance(x, basestring)',
+    'integer': '(isinstance(x, (int, long)) and not isinstance(x, bool))',
+    'number': '(isinstance(x, _Number) and not isinstance(x, bool))',
+    'boolean': 'isinstance(x, bool)',
+    'null': 'x is None',
+    'object': 'isinstance(x, dict)',
+    'array': 'isinstance(x, list)',
+}
+
+OBJECT_KEYWORDS = ('properties', 'patternProperties', 'additionalProperties', 'required')
+ARRAY_KEYWORDS = ('items', )
+STRING_KEYWORDS = ('pattern', )
+NUMBER_KEYWORDS = ('minimum', 'maximum')
+ANY_KEYWORDS = ('type', 'anyOf', 'oneOf')
+SUPPORTED = set(ANNOTATIONS + OBJECT_KEYWORDS + ARRAY_KEYWORDS + STRING_KEYWORDS +
+                NUMBER_KEYWORDS + ANY_KEYWORDS)
+
+
+class _Generator(object):
+
+    def __init__(self):
+        self.lines = []
+        self.patterns = {}
+        self.tables = []
+        self.functions = {}
+        self.bodies = {}
+        self._schemas = []
+
+    def pattern(self, pattern):
+        if pattern not in self.patterns:
+            self.patterns[pattern] = '_re%d' % len(self.patterns)
+        return self.patterns[pattern]
+
+    def function(self, schema):
+        key = id(schema)
+        if key not in self.functions:
+            # 保留引用，避免 id 被复用
+            self._schemas.append(schema)
+            body = tuple(self.body(schema))
+            # 内容相同的子 schema 共用一个函数
+            name = self.bodies.get(body)
+            if name is None:
+                name = self.bodies[body] = '_v%d' % len(self.bodies)
+                self.lines.append('def %s(x):' % name)
+                self.lines.extend('    ' + line for line in body)
+                self.lines.extend(['    return True', ''])
+            self.functions[key] = name
+        return self.functions[key]
+
+    def body(self, schema):
+        unsupported = set(schema) - SUPPORTED
+        if unsupported:
+            raise NotImplementedError('unsupported keywords %s' % ', '.join(sorted(unsupported)))
+        types = schema.get('type')
+        if isinstance(types, basestring):
+            types = [types]
+        lines = []
+        if types:
+            lines.append('if not (%s): return False' % ' or '.join(TYPE_CHECKS[t] for t in types))
+        known = types[0] if types and len(types) == 1 else None
+
+        lines += self.guarded(known, 'string', self.string_lines(schema))
+        lines += self.guarded(known, 'number', self.number_lines(schema))
+        lines += self.guarded(known, 'array', self.array_lines(schema))
+        lines += self.guarded(known, 'object', self.object_lines(schema))
+
+        if 'anyOf' in schema:
+            calls = ['%s(x)' % self.function(s) for s in schema['anyOf']]
+            lines.append('if not (%s): return False' % ' or '.join(calls))
+        if 'oneOf' in schema:
+            calls = ['%s(x)' % self.function(s) for s in schema['oneOf']]
+            lines.append('if %s != 1: return False' % ' + '.join(calls))
+        return lines
+
+    def guarded(self, known, kind, lines):
+        # 类型已经检查过就不用再判断，否则关键字只作用于对应类型的值
+        if not lines or known == kind or (kind == 'number' and known == 'integer'):
+            return lines
+        if known is not None:
+            return []
+        return ['if %s:' % TYPE_CHECKS[kind]] + ['    ' + line for line in lines]
+
+    def table(self, functions):
+        for name, existing in self.tables:
+            if existing == functions:
+                return name
+        name = '_props%d' % len(self.tables)
+        self.tables.append((name, functions))
+        return name
+
+    def string_lines(self, schema):
+        if 'pattern' not in schema:
+            return []
+        return ['if not %s(x): return False' % self.pattern(schema['pattern'])]
+
+    def number_lines(self, schema):
+        lines = []
+        if 'minimum' in schema:
+            lines.append('if x < %r: return False' % schema['minimum'])
+        if 'maximum' in schema:
+            lines.append('if x > %r: return False' % schema['maximum'])
+        return lines
+
+    def array_lines(self, schema):
+        if 'items' not in schema:
+            return []
+        if not isinstance(schema['items'], dict):
+            raise NotImplementedError('items as a list of schemas')
+        return ['for i in x:',
+                '    if not %s(i): return False' % self.function(schema['items'])]
+
+    def object_lines(self, schema):
+        lines = []
+        required = schema.get('required')
+        if required:
+            lines.append('if %s: return False' % ' or '.join('%r not in x' % k for k in required))
+        properties = schema.get('properties') or {}
+        pattern_properties = schema.get('patternProperties') or {}
+        additional = schema.get('additionalProperties', True)
+        if not (properties or pattern_properties or additional is not True):
+            return lines
+
+        loop = []
+        if properties:
+            table = self.table(dict((k, self.function(s)) for k, s in properties.iteritems()))
+            loop.append('f = %s.get(k)' % table)
+            if additional is False and not pattern_properties:
+                loop.append('if f is None or not f(v): return False')
+                additional = True
+            else:
+                loop.append('if f is not None and not f(v): return False')
+        for pattern, subschema in pattern_properties.iteritems():
+            loop += ['if %s(k) and not %s(v): return False'
+                     % (self.pattern(pattern), self.function(subschema))]
+        if additional is not True:
+            # 和 jsonschema 一样，把所有 patternProperties 拼成一个正则判断
+            extra = '%s(k)' % self.pattern('|'.join(pattern_properties)) if pattern_properties else None
+            if properties:
+                extra = 'f is None and not %s' % extra if extra else 'f is None'
+            else:
+                extra = 'not %s' % extra if extra else 'True'
+            if additional is False:
+                loop.append('if %s: return False' % extra)
+            else:
+                loop.append('if %s and not %s(v): return False' % (extra, self.function(additional)))
+        lines.append('for k, v in x.iteritems():')
+        lines.extend('    ' + line for line in loop)
+        return lines
+
+
+def generate_source(schema, name='is_valid'):
+    """
+    :return: python source defining `name(instance) -> bool`
+    """
+    generator = _Generator()
+    root = generator.function(schema)
+    header = ['# -*- coding: utf-8 -*-', '# generated by lain_sdk.yaml.validator.codegen, do not edit',
+              '', 'import re', 'from numbers import Number as _Number', '']
+    for pattern, var in sorted(generator.patterns.iteritems(), key=lambda p: int(p[1][3:])):
+        header.append('%s = re.compile(%r).search' % (var, pattern))
+    header.append('')
+    footer = []
+    for table, functions in generator.tables:
+        items = ', '.join('%r: %s' % (k, f) for k, f in sorted(functions.iteritems()))
+        footer.append('%s = {%s}' % (table, items))
+    footer += ['', '%s = %s' % (name, root), '']
+    return '\n'.join(header + generator.lines + footer)
+
+
+def compile_validator(schema, name='is_valid'):
+    namespace = {}
+    code = compile(generate_source(schema, name), '<lain.yaml schema %s>' % name, 'exec')
+    exec code in namespace
+    return namespace[name]
+
+
+if __name__ == '__main__':
+    from .schema import schema
+    sys.stdout.write(generate_source(schema))
@@ -25,6 +25,9 @@ setup(
     include_package_data=True,
     data_files=[
     ],
-    scripts=['lain_release'],
+    scripts=['lain_release', 'lain_validate', 'lain_build_apps'],
     install_requires=requirements,
+    extras_require={
+        'lua': ['lupa'],
+    },
 )
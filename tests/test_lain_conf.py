@@ -7,7 +7,10 @@ from unittest import TestCase
 from lain_sdk.yaml.parser import (
     LainConf, ProcType, Proc,
     just_simple_scale,
-    render_resource_instance_meta, DEFAULT_SYSTEM_VOLUMES,
+    render_resource_instance_meta, render_resource_instance_metas,
+    DEFAULT_SYSTEM_VOLUMES,
+    get_jinja_render_value, compile_template,
+    RenderPlan, render_instance_yaml, render_parsed_instance_yaml, iterate_parse_yaml_dict,
     DOMAIN,
     MIN_SETUP_TIME, MAX_SETUP_TIME, MIN_KILL_TIMEOUT, MAX_KILL_TIMEOUT
 )
@@ -2051,3 +2054,172 @@ def test_release(release_yaml):
     app_conf.load(release_yaml, 'release', app_meta_version,
                   domains=['registry.lain.local', 'lain.local'])
     assert app_conf.release.copy == [{'dest': '/usr/bin/hello', 'src': 'hello'}, {'dest': 'hi', 'src': 'hi'}]
+
+def _assert_release_conf(app_conf):
+    assert app_conf.appname == 'copy'
+    assert app_conf.procs['web'].memory == '256m'
+    assert app_conf.release.dest_base == 'ubuntu'
+
+def test_load_from_file_object(tmpdir, release_yaml):
+    p = tmpdir.join('lain.yaml')
+    p.write(release_yaml)
+    app_conf = LainConf()
+    with open(p.strpath, 'rb') as f:
+        app_conf.load(f, '123456-abcdefg', None)
+    _assert_release_conf(app_conf)
+    app_conf = LainConf()
+    app_conf.load_file(p.strpath, '123456-abcdefg', None)
+    _assert_release_conf(app_conf)
+
+def test_load_from_mmap(tmpdir, release_yaml):
+    import mmap
+    p = tmpdir.join('lain.yaml')
+    p.write(release_yaml)
+    with open(p.strpath, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            app_conf = LainConf()
+            app_conf.load(m, '123456-abcdefg', None)
+        finally:
+            m.close()
+    _assert_release_conf(app_conf)
+
+def test_load_from_bytes_buffer(release_yaml):
+    for buf in (bytearray(release_yaml), memoryview(release_yaml)):
+        app_conf = LainConf()
+        app_conf.load(buf, '123456-abcdefg', None)
+        _assert_release_conf(app_conf)
+
+def test_sections_are_not_shared_between_confs(release_yaml):
+    release_conf = LainConf()
+    release_conf.load(release_yaml, '123456-abcdefg', None)
+    plain_conf = LainConf()
+    plain_conf.load('appname: plain\nbuild: {base: golang}\n', '123456-abcdefg', None)
+    assert release_conf.test.script == ['( make pylint test )']
+    assert plain_conf.test.script == []
+    assert plain_conf.release.dest_base == ''
+    assert plain_conf.build is not release_conf.build
+
+def test_jinja_render_value_keeps_types():
+    context = {'memory': '128M', 'num': 2}
+    assert get_jinja_render_value(True, context) is True
+    assert get_jinja_render_value(None, context) is None
+    assert get_jinja_render_value(0.5, context) == 0.5
+    assert get_jinja_render_value(3, context) == 3
+    assert get_jinja_render_value('plain', context) == 'plain'
+    assert get_jinja_render_value('8080', context) == 8080
+    assert get_jinja_render_value("{{ memory }}", context) == '128M'
+    assert get_jinja_render_value("{{ num|int }}", context) == 2
+    assert get_jinja_render_value("{{ missing|default(1) }}", context) == 1
+
+def test_compiled_templates_are_cached():
+    assert compile_template('{{ a }}-x') is compile_template('{{ a }}-x')
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_resource_instance_meta_render_batch(processes):
+    registry = 'registry.lain.local'
+    domains = ['lain.local']
+    clients = [
+        ('hello', {'memory': '128M', 'num_instances': 2}),
+        ('world', {}),
+    ]
+    rendered = render_resource_instance_metas(
+        'mysql', MYSQL_RESOURCE_META_VERSION, MYSQL_RESOURCE_META,
+        clients, registry, domains, processes=processes
+    )
+    assert len(rendered) == 2
+    (hello_meta, hello_config), (world_meta, world_config) = rendered
+    assert hello_meta == render_resource_instance_meta(
+        'mysql', MYSQL_RESOURCE_META_VERSION, MYSQL_RESOURCE_META,
+        'hello', clients[0][1], registry, domains)
+    assert hello_config.appname == 'resource.mysql.hello'
+    assert hello_config.procs['mysqld'].memory == '128M'
+    assert hello_config.procs['mysqld'].num_instances == 2
+    assert world_config.appname == 'resource.mysql.world'
+    assert world_config.procs['mysqld'].memory == '64M'
+    assert world_config.procs['mysqld'].num_instances == 1
+    assert 'apptype' not in yaml.safe_load(world_meta)
+
+def test_render_plan_only_renders_templated_leaves():
+    template_yaml = {
+        'appname': 'redis',
+        'build': {'base': 'redis', 'script': ['a', 'b']},
+        'proc.redis': {
+            'memory': '{{ memory|default(\'64M\') }}',
+            'num_instances': '{{ num_instances|default(1) }}',
+            'env': ['A=1', 'B={{ b }}'],
+            'port': '6379',
+        },
+    }
+    plan = RenderPlan(template_yaml)
+    assert sorted(path for path, _ in plan.leaves) == [
+        ('proc.redis', 'env', 1), ('proc.redis', 'memory'), ('proc.redis', 'num_instances')]
+    rendered = plan.render({'b': 'x', 'num_instances': 3})
+    assert rendered['proc.redis'] == {
+        'memory': '64M', 'num_instances': 3, 'env': ['A=1', 'B=x'], 'port': 6379}
+    # 没有模板的子树直接共享，不会被复制
+    assert rendered['build'] is plan.base['build']
+    assert rendered['proc.redis'] is not plan.base['proc.redis']
+    # 多次渲染互不影响
+    assert plan.render({})['proc.redis']['env'] == ['A=1', 'B=']
+    assert rendered['proc.redis']['env'] == ['A=1', 'B=x']
+    assert template_yaml['proc.redis']['port'] == '6379'
+
+def test_render_plan_matches_tree_walk():
+    import copy
+    for template in (REDIS_RESOURCE_META, MYSQL_RESOURCE_META):
+        template_yaml = yaml.safe_load(template)
+        for context in ({}, {'memory': '128M', 'num_instances': 2}):
+            walked = copy.deepcopy(template_yaml)
+            iterate_parse_yaml_dict(walked, context)
+            assert render_parsed_instance_yaml(template_yaml, context) == walked
+
+def test_rendered_instance_yaml_can_be_modified():
+    rendered = render_instance_yaml(REDIS_RESOURCE_META, {})
+    rendered['build']['script'].append('rm -rf /')
+    rendered['release']['copy'][0]['dest'] = '/tmp/hello'
+    rendered['service.redis']['portal']['cmd'] = './evil'
+    # 缓存的 plan 不受调用方修改的影响
+    again = render_instance_yaml(REDIS_RESOURCE_META, {})
+    assert again['build']['script'] == ['go build -o hello']
+    assert again['release']['copy'][0]['dest'] == '/usr/bin/hello'
+    assert again['service.redis']['portal']['cmd'] == './proxy'
+
+def test_load_meta_does_not_modify_meta():
+    import copy
+    meta = yaml.safe_load('''
+appname: hello
+build:
+  base: golang
+  script: [go build -o hello]
+web:
+  cmd: hello
+  dns_search: [example.com]
+  mountpoint: [a.example.com, /api]
+web.admin:
+  cmd: hello
+  mountpoint: [/admin, b.example.com]
+service.echo:
+  cmd: echo
+  port: 1234
+  portal:
+    cmd: proxy
+use_resources:
+  redis:
+    services: [redis]
+    memory: 128M
+''')
+    meta_version = '1428553798.443334-7142797e64bb7b4d057455ef13de6be156ae81cc'
+    before = copy.deepcopy(meta)
+    conf = LainConf()
+    conf.load_meta(meta, meta_version, None, domains=FIXTURES_EXTRA_DOMAINS)
+    assert meta == before
+    assert 'hello.lain' in conf.procs['web'].dns_search
+    assert 'hello.lain/api' in conf.procs['web'].mountpoint
+    assert 'b.example.com' in conf.procs['admin'].mountpoint
+    assert '/admin' not in conf.procs['admin'].mountpoint
+
+    text_conf = LainConf()
+    text_conf.load(yaml.dump(meta), meta_version, None, domains=FIXTURES_EXTRA_DOMAINS)
+    assert text_conf.procs['web'].mountpoint == conf.procs['web'].mountpoint
+    assert text_conf.procs['admin'].mountpoint == conf.procs['admin'].mountpoint
@@ -3,7 +3,8 @@
 
 import pytest
 import yaml
-from lain_sdk.yaml.validator import validate
+from lain_sdk.yaml.validator import (validate, iter_errors, validate_section,
+                                      validate_proc, validate_proc_patch, validate_and_load)
 
 
 def test_lain_yaml_validator_smoke(validation_yaml):
@@ -83,3 +84,70 @@ def test_memory_format(data, want):
     lain_config = yaml.safe_load(data)
     valid, msg = validate(lain_config)
     assert valid == want
+
+
+def test_lain_yaml_validator_all_errors():
+    source_data = yaml.safe_load("""
+appname: test
+build:
+  base: centos
+  script: [make]
+web:
+  cmd: hello
+  memory: 128
+worker.w1:
+  cmd: hello
+  num_instances: two
+""")
+    assert len(list(iter_errors(source_data))) == 2
+    valid, msg = validate(source_data)
+    assert not valid
+    assert '\n' in msg
+    valid, msg = validate(source_data, all_errors=True)
+    assert not valid
+    assert msg.split('\n') == [
+        "web.memory: 128 is not of type 'string'",
+        "worker.w1.num_instances: 'two' is not of type 'integer'",
+    ]
+    assert validate({'appname': 'test', 'build': {'base': 'centos', 'script': []}},
+                    all_errors=True) == (True, 'ok')
+
+
+def test_validate_sections_and_procs():
+    assert validate_section('build', {'base': 'centos', 'script': ['make']}) == (True, 'ok')
+    valid, msg = validate_section('release', {'dest_base': 'centos'}, all_errors=True)
+    assert not valid
+    assert msg == "release: 'copy' is a required property"
+    with pytest.raises(Exception):
+        validate_section('web', {})
+
+    assert validate_proc('web.foo', {'cmd': 'hello', 'memory': '64M'}) == (True, 'ok')
+    assert not validate_proc('web.foo', {'memory': '64M'})[0]
+    assert validate_proc('portal.p', {'allow_clients': '**'}) == (True, 'ok')
+    valid, msg = validate_proc('worker', {'cmd': 'x', 'port': 'http'}, all_errors=True)
+    assert msg == "worker.port: 'http' is not of type 'integer'"
+    with pytest.raises(Exception):
+        validate_proc('bad key', {})
+
+
+def test_validate_proc_patch():
+    # patch 不要求 cmd
+    assert validate_proc_patch('web.foo', {'memory': '128M', 'num_instances': 2}) == (True, 'ok')
+    assert not validate_proc_patch('web.foo', {'memory': '128'})[0]
+    valid, msg = validate_proc_patch('service.s', {'cpu': 'one', 'mem': '1G'}, all_errors=True)
+    assert not valid
+    assert msg.split('\n') == [
+        "service.s.cpu: 'one' is not of type 'integer'",
+        "service.s.mem: Additional properties are not allowed ('mem' was unexpected)",
+    ]
+
+
+def test_validate_and_load(validation_yaml):
+    valid, msg, conf = validate_and_load(validation_yaml, '1428553798-7142797e64bb7b4d057455ef13de6be156ae81cc', None)
+    assert (valid, msg) == (True, 'ok')
+    assert conf.appname == yaml.safe_load(validation_yaml)['appname']
+
+    valid, msg, conf = validate_and_load('appname: test\nbuild: {base: centos, script: []}\nweb: {cmd: x, memory: 1}\n', '1', None)
+    assert not valid and conf is None
+    assert "is not of type 'string'" in msg
+    assert validate_and_load('appname: [', '1', None)[0] is False
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+from io import BytesIO
+
+import jinja2
+import mock
+import pytest
+from lain_sdk import lain_yaml, mydocker
 from lain_sdk.lain_yaml import LainYaml
 
 YAML = 'tests/lain.yaml'
@@ -44,3 +51,181 @@ class TestLainYaml:
         assert len(y.img_temps) == 6
         assert len(y.img_builders) == 6
 
+    def test_phase_results_are_memoized(self):
+        y = LainYaml(YAML, ignore_prepare=True)
+        builds = []
+
+        def builder(phase):
+            def build(context, params, build_args, use_cache=None):
+                builds.append(phase)
+                return y.img_names[phase]
+            return build
+        y.img_builders = dict((phase, builder(phase)) for phase in y.img_builders)
+        version = ['1428553798-a']
+        with mock.patch.object(lain_yaml.mydocker, 'exist', return_value=True), \
+                mock.patch.object(lain_yaml, 'meta_version', side_effect=lambda *args: version[0]):
+            assert y.build_test() == (True, y.img_names['test'])
+            y.build_publish()
+            y.build_meta()
+            y.build_meta()
+            assert builds == ['build', 'test', 'publish', 'meta']
+
+            # 强制重新 build，依赖 build 的 test 结果也失效
+            y.build_base(force=True)
+            y.build_test()
+            y.build_meta()
+            assert builds[4:] == ['build', 'test']
+
+            version[0] = '1428553799-b'
+            y.build_publish()
+            assert builds[6:] == ['build', 'publish']
+
+            y.invalidate_phases('meta')
+            y.build_meta()
+            assert builds[8:] == ['meta']
+
+    def test_publish_does_not_use_build_cache(self):
+        y = LainYaml(YAML, ignore_prepare=True)
+        proc = mock.Mock(stdin=BytesIO())
+        proc.wait.return_value = 0
+        with mock.patch.object(lain_yaml.mydocker, 'BUILD_CACHE_ENABLED', True), \
+                mock.patch.object(lain_yaml.mydocker, 'image_id', return_value='sha256:' + 'a' * 64), \
+                mock.patch.object(lain_yaml.mydocker, 'lookup_build_cache', return_value=True) as lookup, \
+                mock.patch.object(lain_yaml.mydocker, '_docker_popen', return_value=proc) as popen:
+            # test 可以命中 build cache
+            assert y.build_test(use_build=True) == (True, y.img_names['test'])
+            assert lookup.call_count == 1 and popen.call_count == 0
+            # publish 的脚本总是要执行
+            assert y.build_publish(use_build=True) == (True, y.img_names['publish'])
+            assert lookup.call_count == 1 and popen.call_count == 1
+
+    def test_multistage_release(self):
+        y = LainYaml(YAML, ignore_prepare=True)
+        dockerfiles = []
+
+        def fake_build(name, context, ignore, template, params, build_args):
+            dockerfiles.append(jinja2.Template(template).render(**params))
+            return name
+        with mock.patch.object(lain_yaml, 'RELEASE_ENGINE', 'auto'), \
+                mock.patch.object(lain_yaml.mydocker, 'supports_multistage', return_value=True), \
+                mock.patch.object(lain_yaml.mydocker, 'build', side_effect=fake_build):
+            assert y.build_release(use_build=True) == (True, y.img_names['release'])
+        lines = [l.strip() for l in dockerfiles[0].splitlines() if l.strip()]
+        assert lines == ['FROM ubuntu',
+                         'COPY --from=%s /lain/app/hello /usr/bin/hello' % y.img_names['build'],
+                         'WORKDIR /lain/app/']
+
+    def test_release_engine(self):
+        y = LainYaml(YAML, ignore_prepare=True)
+        with mock.patch.object(lain_yaml.mydocker, 'supports_multistage', return_value=False):
+            with mock.patch.object(lain_yaml, 'RELEASE_ENGINE', 'auto'):
+                assert y.release_engine() == 'stream'
+                y.release.copy.append({'src': 'static/*', 'dest': 'static'})
+                assert y.release_engine() == 'legacy'
+            with mock.patch.object(lain_yaml, 'RELEASE_ENGINE', 'multistage'):
+                assert y.release_engine() == 'multistage'
+            with mock.patch.object(lain_yaml, 'RELEASE_ENGINE', 'other'):
+                with pytest.raises(Exception):
+                    y.release_engine()
+
+    def test_stream_release_falls_back_to_legacy(self):
+        y = LainYaml(YAML, ignore_prepare=True)
+        with mock.patch.object(lain_yaml, 'RELEASE_ENGINE', 'stream'), \
+                mock.patch.object(lain_yaml.mydocker, 'image_id', return_value=None), \
+                mock.patch.object(lain_yaml.mydocker, 'build_from_stream',
+                                  side_effect=Exception('no export')), \
+                mock.patch.object(LainYaml, 'release_legacy', return_value='legacy') as legacy:
+            assert y.build_release(use_build=True) == (True, 'legacy')
+        legacy.assert_called_once_with(y.img_names['build'])
+
+    def test_content_addressed_prepare_images(self, tmpdir):
+        def prepare_name(appname, prepare='', files={}, base_id='sha256:' + 'a' * 64):
+            app = tmpdir.mkdir('%s-%d' % (appname, len(tmpdir.listdir())))
+            app.join('lain.yaml').write_binary(
+                open(YAML).read().replace('appname: hello', 'appname: %s' % appname)
+                .replace('  base: golang', '  base: golang\n' + prepare))
+            app.join('main.go').write('package %s\n' % appname)
+            for name, content in files.items():
+                app.ensure(name).write(content)
+            with mock.patch.object(lain_yaml, 'PRIVATE_REGISTRY', 'registry.lain.local'), \
+                    mock.patch.object(lain_yaml.mydocker, 'image_id', return_value=base_id), \
+                    mock.patch.object(lain_yaml.mydocker, 'exist', return_value=True):
+                return LainYaml(str(app.join('lain.yaml'))).img_names['prepare']
+
+        name = prepare_name('hello')
+        assert name.startswith('registry.lain.local/lain-prepare:')
+        # 不同的 app 用相同的输入得到同一个 prepare image，其他源码不影响
+        assert prepare_name('world') == name
+        assert prepare_name('world', files={'README': 'world'}) == name
+        scripts = '  prepare:\n    script:\n      - pip install -r ./requirements.txt\n'
+        requirements = {'requirements.txt': 'flask\n'}
+        assert prepare_name('hello', scripts, requirements) != name
+        assert prepare_name('world', scripts, requirements) == prepare_name('hello', scripts, requirements)
+        # 脚本读的文件变了要重新 build
+        assert prepare_name('hello', scripts, {'requirements.txt': 'django\n'}) != \
+            prepare_name('hello', scripts, requirements)
+        keep = scripts + '    keep:\n      - vendor\n'
+        assert prepare_name('hello', keep, requirements) != prepare_name('hello', scripts, requirements)
+        # keep 下的文件留在 prepare image 里
+        assert prepare_name('hello', keep, dict(requirements, **{'vendor/a.go': 'a'})) != \
+            prepare_name('world', keep, requirements)
+        assert prepare_name('hello', base_id='sha256:' + 'b' * 64) != name
+
+    def test_update_prepare_does_not_overwrite_shared_image(self):
+        y = LainYaml(YAML, ignore_prepare=True)
+        shared = 'registry.lain.local/lain-prepare:' + 'd' * 64
+        y.img_names['prepare'] = shared
+        built = []
+
+        def updater(name, context, params, build_args, use_cache):
+            built.append((name, params['base']))
+            return name
+        y.prepare_updater = updater
+        with mock.patch.object(lain_yaml, 'PRIVATE_REGISTRY', 'registry.lain.local'), \
+                mock.patch.object(lain_yaml.mydocker, 'exist', return_value=True), \
+                mock.patch.object(lain_yaml.mydocker, 'image_id', return_value='sha256:' + 'e' * 64), \
+                mock.patch.object(lain_yaml.mydocker, 'push', return_value=0) as push:
+            ok, name = y.update_prepare()
+        assert ok and name != shared and name.startswith('registry.lain.local/lain-prepare:')
+        assert built == [(name, shared)]
+        push.assert_called_once_with(name)
+        assert y.img_names['prepare'] == name
+
+    def test_prepare_image_falls_back_to_version_without_base(self):
+        with mock.patch.object(lain_yaml, 'PRIVATE_REGISTRY', 'registry.lain.local'), \
+                mock.patch.object(lain_yaml.mydocker, 'image_id', return_value=None), \
+                mock.patch.object(lain_yaml.mydocker, 'pull', return_value=1), \
+                mock.patch.object(LainYaml, 'ensure_proper_shared_image',
+                                  return_value='registry.lain.local/hello:prepare-0-1'):
+            y = LainYaml(YAML)
+            assert y.img_names['prepare'] == 'registry.lain.local/hello:prepare-0-1'
+
+    def test_prepare_image_is_resolved_when_needed(self):
+        lookups = []
+
+        def lookup(name):
+            lookups.append(name)
+            # 本地和 registry 的查找同时进行
+            time.sleep(0.2)
+            return False
+
+        with mock.patch.object(lain_yaml, 'PRIVATE_REGISTRY', 'registry.lain.local'), \
+                mock.patch.object(lain_yaml.mydocker, 'image_id', return_value='sha256:' + 'a' * 64), \
+                mock.patch.object(lain_yaml.mydocker, 'exist', side_effect=lookup), \
+                mock.patch.object(lain_yaml.mydocker, 'exist_in_registry', side_effect=lookup):
+            y = LainYaml(YAML)
+            assert len(y.img_names) == 6 and not y.img_names.is_resolved('prepare')
+            assert lookups == []
+            start = time.time()
+            name = y.img_names['prepare']
+            assert time.time() - start < 0.35
+            assert lookups == [name, name]
+            # 共用查找结果的 app 不再重复查找
+            shared = lain_yaml.PrepareLookups()
+            assert LainYaml(YAML, prepare_lookups=shared).img_names['prepare'] == name
+            assert len(lookups) == 4
+            assert LainYaml(YAML, prepare_lookups=shared).img_names['prepare'] == name
+            assert len(lookups) == 4
+            # 不共用的 app 各自查找，结果不会一直留在进程里
+            assert LainYaml(YAML).img_names['prepare'] == name
+            assert len(lookups) == 6
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import random
+import resource
+import time
+from StringIO import StringIO
+
+import pytest
+from lain_sdk.yaml.guard import LoadLimits, LoadLimitError, guarded_load
+from lain_sdk.yaml.parser import LainConf
+
+META_VERSION = '1428553798.443334-7142797e64bb7b4d057455ef13de6be156ae81cc'
+
+HEADER = '''appname: hello
+build:
+  base: golang
+  script: [go build -o hello]
+'''
+
+TIME_BUDGET = 2.0         # seconds per rejected document
+MEMORY_BUDGET = 64 * 1024  # ru_maxrss is in KB on linux
+
+
+def billion_laughs(rng):
+    fanout, levels = rng.randint(5, 12), rng.randint(6, 12)
+    lines = ['a0: &a0 [%s]' % ','.join(['lol'] * fanout)]
+    for i in range(1, levels):
+        lines.append('a%d: &a%d [%s]' % (i, i, ','.join(['*a%d' % (i - 1)] * fanout)))
+    return HEADER + 'notify: {%s}\n' % ', '.join(lines)
+
+
+def deep_nesting(rng):
+    depth = rng.randint(100, 5000)
+    return HEADER + 'notify: ' + '[' * depth + ']' * depth + '\n'
+
+
+def many_procs(rng):
+    count = rng.randint(300, 3000)
+    procs = ['worker.w%d: {cmd: hello}' % i for i in range(count)]
+    return HEADER + '\n'.join(procs) + '\n'
+
+
+def huge_script_list(rng):
+    count = rng.randint(10001, 16000)
+    return HEADER + 'test:\n  script: [%s]\n' % ','.join(['x'] * count)
+
+
+def oversized(rng):
+    return HEADER + 'notify: {slack: "%s"}\n' % ('x' * rng.randint(2, 4) * 1024 * 1024)
+
+
+def recursive_alias(rng):
+    return HEADER + 'notify: &n {a: *n}\n'
+
+
+def merge_bomb(rng):
+    lines = ['m0: &m0 {%s}' % ', '.join('k%d: v' % i for i in range(rng.randint(8, 16)))]
+    for i in range(1, rng.randint(18, 24)):
+        lines.append('m%d: &m%d {<<: [*m%d, *m%d], x%d: 1}' % (i, i, i - 1, i - 1, i))
+    return HEADER + 'notify: {%s}\n' % ', '.join(lines)
+
+
+GENERATORS = [billion_laughs, deep_nesting, many_procs, huge_script_list,
+              oversized, recursive_alias, merge_bomb]
+
+
+@pytest.mark.parametrize('seed', range(14))
+def test_fuzzed_worst_case_inputs_are_rejected_within_budget(seed):
+    rng = random.Random(seed)
+    generator = GENERATORS[seed % len(GENERATORS)]
+    meta_yaml = generator(rng)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    with pytest.raises(LoadLimitError):
+        LainConf().load(meta_yaml, META_VERSION, None)
+    assert time.time() - start < TIME_BUDGET
+    assert resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss < MEMORY_BUDGET
+
+
+def test_limits_are_configurable():
+    meta_yaml = HEADER + '\n'.join('worker.w%d: {cmd: hello}' % i for i in range(5))
+    conf = LainConf()
+    conf.limits = LoadLimits(max_procs=4)
+    with pytest.raises(LoadLimitError) as e:
+        conf.load(meta_yaml, META_VERSION, None)
+    assert 'more than 4 procs' in str(e.value)
+    conf.limits = LoadLimits(max_procs=None)
+    conf.load(meta_yaml, META_VERSION, None)
+    assert len(conf.procs) == 5
+
+
+def test_stream_size_is_checked_while_reading():
+    with pytest.raises(LoadLimitError):
+        guarded_load(StringIO(HEADER * 100), LoadLimits(max_bytes=1000))
+    assert guarded_load(StringIO(HEADER), LoadLimits(max_bytes=1000))['appname'] == 'hello'
+
+
+def test_unicode_size_is_counted_in_bytes():
+    # 300 个字符，UTF-8 编码后 900 字节
+    meta_yaml = u'appname: hello\nnotify: {slack: "%s"}\n' % (u'\u4f60' * 300)
+    limits = LoadLimits(max_bytes=500)
+    assert len(meta_yaml) < 500
+    with pytest.raises(LoadLimitError):
+        guarded_load(meta_yaml, limits)
+    with pytest.raises(LoadLimitError):
+        guarded_load(StringIO(meta_yaml), limits)
+    assert guarded_load(meta_yaml, LoadLimits(max_bytes=1000))['appname'] == 'hello'
+
+
+def test_moderate_aliases_are_allowed():
+    meta = guarded_load(HEADER + 'notify: {a: &a [1, 2], b: *a, c: *a}\n')
+    assert meta['notify']['c'] == [1, 2]
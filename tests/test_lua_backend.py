@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from lain_sdk.yaml.backend import load_lain_conf
+from lain_sdk.yaml.parser import ProcType, SocketType
+
+lupa = pytest.importorskip('lupa')
+
+META_VERSION = '1428553798.443334-7142797e64bb7b4d057455ef13de6be156ae81cc'
+
+META_YAML = '''
+appname: hello
+build:
+    base: golang
+    script: [go build -o hello]
+release:
+    dest_base: ubuntu
+    copy:
+        - {src: hello, dest: /usr/bin/hello}
+publish:
+    script: [go test]
+web:
+    cmd: hello
+    port: 80
+    env: [ENV_A=enva]
+service.echo:
+    cmd: ./echo -p 1234
+    port: "1234:udp"
+    num_instances: 3
+    portal:
+        allow_clients: "**"
+        cmd: ./proxy
+'''
+
+
+def test_lua_backend_smoke():
+    conf = load_lain_conf(META_YAML, META_VERSION, None, backend='lua',
+                          registry='registry.lain.local')
+    assert conf.appname == 'hello'
+    assert sorted(conf.procs) == ['echo', 'portal-echo', 'web']
+    web = conf.procs['web']
+    assert web.type == ProcType.web
+    assert web.cmd == ['hello']
+    assert web.port[80].type == SocketType.tcp
+    assert web.env == ['ENV_A=enva']
+    assert web.image == 'registry.lain.local/hello:release-%s' % META_VERSION
+    echo = conf.procs['echo']
+    assert echo.num_instances == 3
+    assert echo.port[1234].type == SocketType.udp
+    assert conf.procs['portal-echo'].type == ProcType.portal
+    assert conf.procs['portal-echo'].service_name == 'echo'
+    assert conf.build.base == 'golang'
+    assert conf.build.script == ['( go build -o hello )']
+    assert conf.release.copy == [{'src': 'hello', 'dest': '/usr/bin/hello'}]
+    assert conf.publish.script == ['( go test )']
+
+
+def test_lua_backend_errors():
+    with pytest.raises(Exception) as e:
+        load_lain_conf('build: {base: golang}', META_VERSION, None, backend='lua')
+    assert 'no appname' in str(e.value)
+    assert 'traceback' not in str(e.value)
+
+
+def test_lua_backend_reuses_runtimes():
+    from lain_sdk.yaml.lua_backend import LuaRuntimePool, load
+    pool = LuaRuntimePool(size=1)
+    first = load(META_YAML, META_VERSION, None, pool=pool)
+    second = load(META_YAML, META_VERSION, None, pool=pool)
+    assert pool._created == 1
+    assert sorted(first.procs) == sorted(second.procs)
+
+
+def test_unknown_backend():
+    with pytest.raises(Exception):
+        load_lain_conf(META_YAML, META_VERSION, None, backend='go')
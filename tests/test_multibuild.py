@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import mock
+from lain_sdk import lain_yaml, multibuild
+from lain_sdk.lain_yaml import LainYaml
+from lain_sdk.phases import PhaseResult, SUCCEEDED, FAILED
+
+YAML = 'tests/lain.yaml'
+
+
+def write_apps(tmpdir, names):
+    paths = []
+    for name in names:
+        path = tmpdir.mkdir(name).join('lain.yaml')
+        path.write_binary(open(YAML).read().replace('appname: hello', 'appname: %s' % name))
+        paths.append(str(path))
+    return paths
+
+
+def fake_build_phases(self, targets, workers):
+    status = FAILED if self.appname == 'broken' else SUCCEEDED
+    return dict((p, PhaseResult(p, status, '%s:%s' % (self.appname, p), 0, 0.01)) for p in targets)
+
+
+def test_apps_share_prepare_images_and_base_pulls(tmpdir):
+    paths = write_apps(tmpdir, ['a1', 'a2', 'a3', 'broken'])
+    paths.append(str(tmpdir.join('missing', 'lain.yaml')))
+    prepares = []
+    pulls = []
+    lock = threading.Lock()
+
+    def fake_build_prepare(self):
+        with lock:
+            prepares.append(self.appname)
+        time.sleep(0.05)
+        return (True, self.img_names['prepare'])
+
+    def fake_pull(name):
+        with lock:
+            pulls.append(name)
+        return 0
+
+    with mock.patch.object(LainYaml, 'resolve_prepare_image', return_value='registry/lain-prepare:x'), \
+            mock.patch.object(LainYaml, 'build_prepare', fake_build_prepare), \
+            mock.patch.object(LainYaml, 'build_phases', fake_build_phases), \
+            mock.patch.object(multibuild.mydocker, 'image_id', return_value=None), \
+            mock.patch.object(multibuild.mydocker, 'pull', side_effect=fake_pull):
+        builder = multibuild.AppsBuilder(('release', 'meta'), workers=3)
+        results = builder.run(paths)
+
+    assert len(prepares) == 1
+    assert sorted(pulls) == ['golang', 'ubuntu']
+    assert builder.prepare_images == ['registry/lain-prepare:x']
+    assert [r.yaml_path for r in results] == paths
+    assert [r.ok for r in results] == [True, True, True, False, False]
+    assert results[0].images == ['a1:release', 'a1:meta']
+    assert results[3].error == 'phases not built: release, meta'
+    assert results[4].appname is None and 'invalid lain.yaml' in results[4].error
+
+
+def test_apps_with_the_same_prepare_inputs_build_it_once(tmpdir):
+    paths = write_apps(tmpdir, ['a1', 'a2'])
+    # 源码不同，但 prepare 的输入相同
+    for path in paths:
+        app = os.path.dirname(path)
+        with open(os.path.join(app, 'main.go'), 'w') as f:
+            f.write('package %s\n' % os.path.basename(app))
+    built = []
+
+    def fake_build_prepare(self):
+        built.append(self.img_names['prepare'])
+        return (True, self.img_names['prepare'])
+
+    with mock.patch.object(lain_yaml, 'PRIVATE_REGISTRY', 'registry.lain.local'), \
+            mock.patch.object(LainYaml, 'build_prepare', fake_build_prepare), \
+            mock.patch.object(LainYaml, 'build_phases', fake_build_phases), \
+            mock.patch.object(multibuild.mydocker, 'image_id', return_value='sha256:' + 'a' * 64), \
+            mock.patch.object(multibuild.mydocker, 'exist', return_value=False), \
+            mock.patch.object(multibuild.mydocker, 'exist_in_registry', return_value=False):
+        builder = multibuild.AppsBuilder(('release', ), workers=2)
+        results = builder.run(paths)
+
+    assert [r.ok for r in results] == [True, True]
+    assert len(builder.prepare_images) == 1
+    assert builder.prepare_images[0].startswith('registry.lain.local/lain-prepare:')
+    assert built == builder.prepare_images
+
+
+def test_apps_of_a_builder_share_prepare_lookups(tmpdir):
+    builder = multibuild.AppsBuilder()
+    other = multibuild.AppsBuilder()
+    apps, failures = builder.load(write_apps(tmpdir, ['a1', 'a2']))
+    assert failures == []
+    assert [app.prepare_lookups for _, app in apps] == [builder.prepare_lookups] * 2
+    assert builder.prepare_lookups is not other.prepare_lookups
+
+
+def test_main_reports_every_app(tmpdir, capsys):
+    write_apps(tmpdir, ['a1', 'broken'])
+    with mock.patch.object(LainYaml, 'build_phases', fake_build_phases), \
+            mock.patch.object(multibuild.mydocker, 'image_id', return_value='sha256:' + 'a' * 64):
+        assert multibuild.main(['--targets', 'meta', str(tmpdir)]) == 1
+    out = capsys.readouterr()[0]
+    assert 'a1:meta' in out
+    assert '2 apps built' in out and '1 failed' in out
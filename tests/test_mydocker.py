@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tarfile
+import threading
+import time
+from io import BytesIO
+
+import mock
+import pytest
+from lain_sdk import mydocker
+
+
+def test_concurrent_builds_in_one_context(tmpdir):
+    context = str(tmpdir)
+    tmpdir.join('.dockerignore').write('*.log\n')
+    seen = []
+
+    def fake_docker(args, cwd=None, **kwargs):
+        dockerfile = args[args.index('-f') + 1]
+        with open(os.path.join(cwd, dockerfile)) as f:
+            content = f.read()
+        with open(os.path.join(cwd, '.dockerignore')) as f:
+            ignore = f.read()
+        seen.append((args[2], dockerfile, content, ignore))
+        time.sleep(0.05)
+        return 0
+
+    with mock.patch.object(mydocker, '_docker', side_effect=fake_docker), \
+            mock.patch.object(mydocker, 'SDK_CONTEXT', False):
+        threads = [threading.Thread(target=mydocker.build, args=(
+            'img%d' % i, context, ['.git'], 'FROM {{ base }}\nCOPY . /app', {'base': 'base%d' % i}, [], False))
+            for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert sorted(name for name, _, _, _ in seen) == ['img0', 'img1', 'img2', 'img3']
+    assert len(set(dockerfile for _, dockerfile, _, _ in seen)) == 4
+    for name, _, content, ignore in seen:
+        assert content == 'FROM base%s\nCOPY . /app' % name[-1]
+        assert ignore.startswith('*.log\n')
+        assert '.git\n' in ignore and mydocker.DOCKERFILE_PREFIX + '*\n' in ignore
+    # 生成的文件都已删除，原来的 .dockerignore 已恢复
+    assert sorted(os.listdir(context)) == ['.dockerignore']
+    assert tmpdir.join('.dockerignore').read() == '*.log\n'
+
+
+BASE_ID = 'sha256:' + 'a' * 64
+BUILT_ID = 'sha256:' + 'b' * 64
+
+
+@pytest.fixture
+def context(tmpdir):
+    tmpdir.join('.dockerignore').write('*.log\nbuild\n')
+    tmpdir.join('app.py').write('print 1\n')
+    tmpdir.join('debug.log').write('x')
+    tmpdir.mkdir('build').join('out').write('x')
+    tmpdir.mkdir('src').join('main.py').write('main\n')
+    return tmpdir
+
+
+def fake_inspect(args, capture_output=False, **kwargs):
+    assert args[:3] == ['inspect', '--format', '{{.Id}}']
+    return BASE_ID if args[3] == 'base' else ''
+
+
+def test_build_cache_key_follows_context(context):
+    dockerfile = 'FROM base\nCOPY . /lain/app\n'
+    with mock.patch.object(mydocker, '_docker', side_effect=fake_inspect):
+        key = mydocker.build_cache_key(str(context), dockerfile, ['A=1'])
+        assert mydocker.build_cache_key(str(context), dockerfile, ['A=1']) == key
+        assert mydocker.build_cache_key(str(context), dockerfile, ['A=2']) != key
+        # 被 .dockerignore 忽略的文件不影响 key
+        context.join('other.log').write('y')
+        context.join('build', 'more').write('y')
+        assert mydocker.build_cache_key(str(context), dockerfile, ['A=1']) == key
+        context.join('src', 'main.py').write('changed\n')
+        assert mydocker.build_cache_key(str(context), dockerfile, ['A=1']) != key
+        # 不 COPY 的 Dockerfile 和 context 无关
+        plain = mydocker.build_cache_key(str(context), 'FROM base\nRUN true\n', [])
+        context.join('app.py').write('print 2\n')
+        assert mydocker.build_cache_key(str(context), 'FROM base\nRUN true\n', []) == plain
+        # base image 不在本地时不用 cache
+        assert mydocker.build_cache_key(str(context), 'FROM missing\n', []) is None
+
+
+def test_dockerignore_semantics():
+    def ignored(path, *patterns):
+        return mydocker.DockerIgnore(patterns).matches(path)
+    assert ignored('a.log', '*.log')
+    assert not ignored('src/a.log', '*.log')
+    assert ignored('src/a.log', '*/*.log')
+    assert ignored('src/a.log', '**/*.log')
+    assert ignored('a.log', '**/*.log')
+    assert ignored('a/b/c/d.log', 'a/**/d.log')
+    assert ignored('build/out/x', 'build')
+    assert ignored('build/out/x', '/build/')
+    assert ignored('src/a.pyc', 'src/*.py?')
+    assert ignored('b1', 'b[0-9]')
+    assert not ignored('bx', 'b[0-9]')
+    assert ignored('a.b', 'a.b') and not ignored('axb', 'a.b')
+    assert ignored('x', '**')
+    # 最后一个匹配的 pattern 生效
+    assert not ignored('a.log', '*.log', '!a.log')
+    assert ignored('a.log', '!a.log', '*.log')
+    assert not ignored('build/keep', 'build', '!build/keep')
+    assert ignored('build/other', 'build', '!build/keep')
+    assert not ignored('a.log', '# *.log')
+
+
+def test_second_identical_build_hits_cache(context):
+    labelled = {}
+    calls = []
+
+    def fake_docker(args, cwd=None, capture_output=False, **kwargs):
+        calls.append(args[0])
+        if args[0] == 'inspect':
+            return {'base': BASE_ID, 'img': labelled.get('img', '')}.get(args[3], '')
+        if args[0] == 'images':
+            label = args[-1][len('label='):]
+            return '\n'.join(i for i, l in labelled.items() if l == label)
+        if args[0] == 'build':
+            with open(os.path.join(cwd, args[args.index('-f') + 1])) as f:
+                content = f.read()
+            label = content.strip().splitlines()[-1]
+            assert label.startswith('LABEL %s=' % mydocker.BUILD_CACHE_LABEL)
+            labelled[BUILT_ID] = label.split(' ', 1)[1]
+            labelled['img'] = BUILT_ID
+            return 0
+        raise AssertionError(args)
+
+    stats = dict(mydocker.build_cache_stats)
+    with mock.patch.object(mydocker, '_docker', side_effect=fake_docker), \
+            mock.patch.object(mydocker, 'SDK_CONTEXT', False), \
+            mock.patch.object(mydocker, 'get_image_labels_in_registry', return_value={}):
+        args = ('img', str(context), [], 'FROM base\nCOPY . /app\n', {}, [], True)
+        assert mydocker.build(*args) == 'img'
+        assert calls.count('build') == 1
+        assert mydocker.build(*args) == 'img'
+        assert calls.count('build') == 1
+    assert mydocker.build_cache_stats['misses'] == stats['misses'] + 1
+    assert mydocker.build_cache_stats['hits'] == stats['hits'] + 1
+
+
+def test_split_image_name():
+    assert mydocker.split_image_name('registry.lain.local/hello:release-1') == \
+        ('registry.lain.local', 'hello', 'release-1')
+    assert mydocker.split_image_name('localhost:5000/a/b') == ('localhost:5000', 'a/b', 'latest')
+    assert mydocker.split_image_name('hello:1') == (None, 'hello', '1')
+
+
+def test_build_cache_key_follows_copy_from_images(context):
+    dockerfile = 'FROM base\nCOPY --from=build /lain/app/hello /usr/bin/hello\n'
+    ids = {'base': BASE_ID, 'build': BUILT_ID}
+    with mock.patch.object(mydocker, '_docker',
+                           side_effect=lambda args, **kwargs: ids.get(args[3], '')):
+        key = mydocker.build_cache_key(str(context), dockerfile, [])
+        # 只从镜像 COPY，context 不影响 key
+        context.join('app.py').write('print 2\n')
+        assert mydocker.build_cache_key(str(context), dockerfile, []) == key
+        ids['build'] = 'sha256:' + 'c' * 64
+        assert mydocker.build_cache_key(str(context), dockerfile, []) != key
+        del ids['build']
+        assert mydocker.build_cache_key(str(context), dockerfile, []) is None
+
+
+def make_tar(files):
+    buf = BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, content in files:
+        member = tarfile.TarInfo(name)
+        if content is None:
+            member.type = tarfile.DIRTYPE
+            tar.addfile(member)
+        else:
+            member.size = len(content)
+            tar.addfile(member, BytesIO(content))
+    tar.close()
+    return buf.getvalue()
+
+
+class Pipe(BytesIO):
+
+    # 关闭后还要读出写入的内容
+    def close(self):
+        pass
+
+
+class FakeProc(object):
+
+    def __init__(self, stdout=''):
+        self.stdout = BytesIO(stdout)
+        self.stdin = Pipe()
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.returncode = 0
+        return 0
+
+    def kill(self):
+        self.returncode = -9
+
+
+CONTAINER_ID = 'c' * 64
+EXPORTED = [('lain', None), ('lain/app', None), ('lain/app/hello', 'binary'),
+            ('lain/app/hello.go', 'source'), ('lain/app/static', None),
+            ('lain/app/static/a.css', 'css'), ('usr/bin/go', 'go')]
+
+
+def test_stream_release_context():
+    procs = []
+    docker_calls = []
+
+    def fake_popen(args, **kwargs):
+        proc = FakeProc(make_tar(EXPORTED) if args[0] == 'export' else '')
+        procs.append((args, proc))
+        return proc
+
+    def fake_docker(args, **kwargs):
+        docker_calls.append(args)
+        return CONTAINER_ID if args[0] == 'create' else 0
+
+    copy_list = [('/lain/app/hello', '/usr/bin/hello'), ('/lain/app/static', '/srv/static')]
+    with mock.patch.object(mydocker, '_docker_popen', side_effect=fake_popen), \
+            mock.patch.object(mydocker, '_docker', side_effect=fake_docker):
+        name = mydocker.build_from_stream(
+            'hello:release', 'FROM {{ base }}\n', {'base': 'ubuntu'},
+            lambda tar: mydocker.export_paths('hello:build', copy_list, tar), use_cache=False)
+    assert name == 'hello:release'
+    dockerfile = procs[0][0][4]
+    assert dockerfile.startswith(mydocker.DOCKERFILE_PREFIX)
+    assert [args for args, _ in procs] == [['build', '-t', 'hello:release', '-f', dockerfile, '-'],
+                                           ['export', CONTAINER_ID]]
+    assert docker_calls == [['create', 'hello:build'], ['rm', '-f', CONTAINER_ID]]
+
+    context = tarfile.open(fileobj=BytesIO(procs[0][1].stdin.getvalue()))
+    assert context.getnames() == [dockerfile, '.dockerignore', 'release/0', 'release/1',
+                                  'release/1/a.css']
+    assert context.extractfile(dockerfile).read() == 'FROM ubuntu'
+    assert context.extractfile('.dockerignore').read().split() == ['.dockerignore', dockerfile]
+    assert context.extractfile('release/0').read() == 'binary'
+    assert context.extractfile('release/1/a.css').read() == 'css'
+
+
+def test_stream_release_context_requires_every_source():
+    with mock.patch.object(mydocker, '_docker_popen', return_value=FakeProc(make_tar(EXPORTED))), \
+            mock.patch.object(mydocker, '_docker', return_value=CONTAINER_ID) as docker:
+        tar = tarfile.open(fileobj=BytesIO(), mode='w|')
+        with pytest.raises(Exception) as e:
+            mydocker.export_paths('hello:build', [('/lain/app/missing', '/x')], tar)
+    assert '/lain/app/missing' in str(e.value)
+    # 出错时也要删掉创建的容器
+    docker.assert_called_with(['rm', '-f', CONTAINER_ID], print_stdout=False)
+
+
+def test_context_sources():
+    assert mydocker.context_sources('FROM a\nRUN true\n') == []
+    assert mydocker.context_sources('FROM a\nCOPY lain.yaml /lain.yaml\n') == ['lain.yaml']
+    assert mydocker.context_sources('FROM a\ncopy --chown=1 a b /x/\nADD . /app\n') == ['a', 'b', '.']
+    assert mydocker.context_sources('FROM a\nCOPY --from=b /x /y\n') == []
+    assert mydocker.context_sources('FROM a\nCOPY ["a", "/b"]\n') is None
+
+
+def test_build_sends_only_referenced_files(context):
+    streamed = []
+
+    def fake_stream(name, template, params, write_context, digest, use_cache, build_args):
+        tar = tarfile.open(fileobj=BytesIO(), mode='w|')
+        write_context(tar)
+        streamed.append([m.name for m in tar.members])
+        return name
+
+    with mock.patch.object(mydocker, 'build_from_stream', side_effect=fake_stream), \
+            mock.patch.object(mydocker, 'SDK_CONTEXT', False), \
+            mock.patch.object(mydocker, 'build_image', return_value='full') as build_image:
+        build = lambda template: mydocker.build('img', str(context), [], template, {}, [], False)
+        assert build('FROM base\nRUN make\n') == 'img'
+        assert build('FROM scratch\nCOPY app.py /app.py\n') == 'img'
+        assert streamed == [[], ['app.py']]
+        # 整个目录、通配符、被忽略或不存在的文件还是发送整个 context
+        for template in ('FROM base\nCOPY . /app\n', 'FROM base\nCOPY *.py /app/\n',
+                         'FROM base\nCOPY debug.log /\n', 'FROM base\nCOPY src /src\n',
+                         'FROM base\nCOPY missing /\n'):
+            assert build(template) == 'full'
+        assert build_image.call_count == 5
+
+
+def test_context_tar_honors_dockerignore(context):
+    context.join('.dockerignore').write('*.log\nbuild\n!build/keep\n')
+    context.join('build', 'keep').write('kept')
+    context.join('src').join('link').mksymlinkto('main.py')
+    patterns = mydocker.context_ignore_patterns(str(context), ['.git'])
+    context_tar = mydocker.ContextTar(str(context), patterns)
+    try:
+        tar = tarfile.open(context_tar.path)
+        # 和 docker 一样，被忽略的目录本身不发送，只发送 `!` 找回的文件
+        assert sorted(tar.getnames()) == ['app.py', 'build/keep', 'src',
+                                          'src/link', 'src/main.py']
+        assert tar.extractfile('build/keep').read() == 'kept'
+        assert tar.getmember('src/link').linkname == 'main.py'
+        assert context_tar.files == 4
+        assert context_tar.digest == mydocker.context_digest(str(context), patterns)
+    finally:
+        context_tar.remove()
+
+
+def test_context_tar_is_built_once_per_session(context):
+    streamed = []
+
+    def fake_popen(args, **kwargs):
+        proc = FakeProc()
+        streamed.append(proc)
+        return proc
+
+    built = []
+    real_context_tar = mydocker.ContextTar
+
+    def counting_context_tar(*args):
+        built.append(args)
+        return real_context_tar(*args)
+
+    with mock.patch.object(mydocker, '_docker_popen', side_effect=fake_popen), \
+            mock.patch.object(mydocker, 'ContextTar', side_effect=counting_context_tar):
+        build = lambda name: mydocker.build(name, str(context), ['.git'],
+                                            'FROM base\nCOPY . /app\n', {}, [], False)
+        assert build('prepare') == 'prepare'
+        assert build('build') == 'build'
+        assert len(built) == 1
+        context.join('app.py').write('print 3\n')
+        assert build('build') == 'build'
+        assert len(built) == 2
+    mydocker.remove_context_tars()
+
+    names = [sorted(tarfile.open(fileobj=BytesIO(p.stdin.getvalue())).getnames()) for p in streamed]
+    assert len(names) == 3
+    for n in names:
+        assert [x for x in n if not x.startswith(mydocker.DOCKERFILE_PREFIX)] == \
+            ['.dockerignore', 'app.py', 'src', 'src/main.py']
+    content = tarfile.open(fileobj=BytesIO(streamed[2].stdin.getvalue())).extractfile('app.py').read()
+    assert content == 'print 3\n'
+
+
+def test_context_tars_of_different_contexts_build_concurrently(tmpdir):
+    contexts = []
+    for name in ('a', 'b'):
+        d = tmpdir.mkdir(name)
+        d.join('app.py').write(name)
+        contexts.append(str(d))
+    both_building = threading.Event()
+    building = []
+    real_context_tar = mydocker.ContextTar
+
+    def slow_context_tar(*args):
+        building.append(args[0])
+        if len(building) == 2:
+            both_building.set()
+        # 全局锁下打包的话，第二个 context 永远等不到这里
+        assert both_building.wait(5)
+        return real_context_tar(*args)
+
+    with mock.patch.object(mydocker, 'ContextTar', side_effect=slow_context_tar):
+        threads = [threading.Thread(target=mydocker.get_context_tar, args=(c, []))
+                   for c in contexts]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+    try:
+        assert sorted(building) == contexts
+        assert both_building.is_set()
+    finally:
+        mydocker.remove_context_tars()
+
+
+def test_context_tars_are_dropped_with_their_context(tmpdir):
+    kept, gone = tmpdir.mkdir('kept'), tmpdir.mkdir('gone')
+    kept.join('app.py').write('kept')
+    gone.join('app.py').write('gone')
+    kept_tar = mydocker.get_context_tar(str(kept), [])
+    gone_tar = mydocker.get_context_tar(str(gone), [])
+
+    gone.remove()
+    assert mydocker.get_context_tar(str(kept), []) is kept_tar
+    assert not os.path.exists(gone_tar.path)
+
+    mydocker.remove_context_tars(str(kept))
+    assert not os.path.exists(kept_tar.path)
+    assert mydocker.get_context_tar(str(kept), []) is not kept_tar
+    mydocker.remove_context_tars()
+
+
+def test_failed_container_is_found_by_its_script():
+    cmds = {
+        'publish': ['/bin/sh', '-c', '( ./publish.sh )'],
+        'test': ['/bin/sh', '-c', '( go test ) && ( ./lint.sh )'],
+        'other': ['/bin/sh', '-c', '( go build )'],
+    }
+
+    def fake_docker(args, capture_output=False, **kwargs):
+        if args[0] == 'ps':
+            assert 'ancestor=hello:build' in args
+            # 最新的容器是同时 build 的 publish 留下的
+            return 'publish\ntest\nother\n'
+        assert args[:3] == ['inspect', '--format', '{{json .Config.Cmd}}']
+        return json.dumps(cmds[args[3]])
+
+    with mock.patch.object(mydocker, '_docker', side_effect=fake_docker):
+        assert mydocker.get_failed_container_id('hello:build', ['( go test )', '( ./lint.sh )']) == 'test'
+        assert mydocker.get_failed_container_id('hello:build', ['( ./publish.sh )']) == 'publish'
+        assert mydocker.get_failed_container_id('hello:build', ['( ./deploy.sh )']) == -1
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from lain_sdk.yaml.parser import LainConf
+from lain_sdk.yaml.parity import (generate_documents, conf_fields, compare,
+                                  corpus_paths, META_VERSION)
+
+
+def test_generated_documents_load():
+    docs = generate_documents(20, seed=1)
+    assert len(docs) == 20
+    for _, meta_yaml in docs:
+        conf = LainConf()
+        conf.load(meta_yaml, META_VERSION, None)
+        assert conf.procs
+
+
+def test_conf_fields():
+    _, meta_yaml = generate_documents(1, seed=2)[0]
+    first, second = LainConf(), LainConf()
+    first.load(meta_yaml, META_VERSION, None)
+    second.load(meta_yaml, META_VERSION, None)
+    assert conf_fields(first) == conf_fields(second)
+    second.build.base = 'other'
+    assert conf_fields(first)['build.base'] != conf_fields(second)['build.base']
+
+
+def test_corpus_paths():
+    paths = corpus_paths()
+    assert any(p.endswith('test/2.yaml') for p in paths)
+    assert any(p.endswith('test_json/2.json') for p in paths)
+
+
+def test_compare_reports_field_divergence():
+    pytest.importorskip('lupa')
+    meta_yaml = '''
+appname: hello
+build: {base: golang, script: [go build]}
+worker.foo: {cmd: foo}
+'''
+    paths = [path for path, _, _ in compare(meta_yaml)]
+    # lua 给所有 proc 默认 80 端口
+    assert paths == ['procs.foo.port']
+    assert compare('build: {base: golang}') == []
+
+
+def test_compare_allow_clients_and_volumes():
+    pytest.importorskip('lupa')
+    meta_yaml = '''
+appname: hello
+build: {base: golang, script: [go build]}
+worker.db:
+  cmd: db
+  port: 80
+  volumes: [data/, /var/lib/mysql/]
+  logs: [db.log]
+worker.cache:
+  cmd: cache
+  port: 80
+  persistent_dirs:
+    - /cache: {backup_full: {schedule: '0 * * * *'}}
+  volumes: [ignored]
+service.echo:
+  cmd: echo
+  port: 1234
+  portal: {cmd: proxy, allow_clients: hello}
+'''
+    # 端口的差异是 lua 的默认值，见上面的测试
+    assert [path for path, _, _ in compare(meta_yaml)] == ['procs.portal-echo.port']
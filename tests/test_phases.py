@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import mock
+import pytest
+from lain_sdk.lain_yaml import LainYaml
+from lain_sdk.phases import (run_phases, required_phases, PhaseResult,
+                             SUCCEEDED, FAILED, SKIPPED)
+
+YAML = 'tests/lain.yaml'
+
+
+def _runner(calls, phase, ok=True, delay=0.0):
+    def run():
+        calls.append((phase, time.time()))
+        time.sleep(delay)
+        return (ok, '%s-image' % phase if ok else None)
+    return run
+
+
+def test_required_phases():
+    assert required_phases(['test']) == set(['prepare', 'build', 'test'])
+    assert required_phases(['meta']) == set(['meta'])
+    with pytest.raises(Exception):
+        required_phases(['deploy'])
+
+
+def test_independent_phases_run_concurrently():
+    calls = []
+    runners = dict((p, _runner(calls, p, delay=0.2)) for p in
+                   ('prepare', 'build', 'release', 'test', 'publish', 'meta'))
+    start = time.time()
+    results = run_phases(runners, ['release', 'test', 'publish', 'meta'], workers=4)
+    elapsed = time.time() - start
+    assert sorted(p for p, _ in calls) == sorted(runners)
+    assert all(r.status == SUCCEEDED for r in results.values())
+    assert results['test'].image == 'test-image'
+    started = dict(calls)
+    # 关键路径是 prepare -> build -> release/test/publish
+    assert started['build'] >= started['prepare'] + 0.2
+    assert min(started[p] for p in ('release', 'test', 'publish')) >= started['build'] + 0.2
+    assert elapsed < 0.2 * 3 + 0.3
+
+
+def test_worker_count_limits_concurrency():
+    active = [0, 0]
+    lock = threading.Lock()
+
+    def run():
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return True, None
+    runners = dict((p, run) for p in ('prepare', 'build', 'release', 'test', 'publish', 'meta'))
+    run_phases(runners, ['release', 'test', 'publish', 'meta'], workers=2)
+    assert active[1] == 2
+
+
+def test_failed_phase_skips_dependents():
+    calls = []
+    runners = {
+        'prepare': _runner(calls, 'prepare'),
+        'build': _runner(calls, 'build', ok=False),
+        'release': _runner(calls, 'release'),
+        'test': _runner(calls, 'test'),
+        'meta': _runner(calls, 'meta'),
+    }
+    results = run_phases(runners, ['release', 'test', 'meta'])
+    assert results['build'].status == FAILED
+    assert results['release'].status == SKIPPED
+    assert results['test'].status == SKIPPED
+    assert results['meta'].status == SUCCEEDED
+    assert sorted(p for p, _ in calls) == ['build', 'meta', 'prepare']
+
+
+def test_lain_yaml_build_phases():
+    y = LainYaml(YAML, ignore_prepare=True)
+    methods = ['build_prepare', 'build_base', 'build_release', 'build_test',
+               'build_publish', 'build_meta']
+    mocks = dict((m, mock.Mock(return_value=(True, m))) for m in methods)
+    with mock.patch.multiple(y, **mocks):
+        results = y.build_phases(workers=3)
+    assert set(results) == set(['prepare', 'build', 'release', 'test', 'publish', 'meta'])
+    for m in methods:
+        assert mocks[m].call_count == 1
+    mocks['build_base'].assert_called_with(use_prepare=True)
+    for m in ('build_release', 'build_test', 'build_publish'):
+        mocks[m].assert_called_with(use_build=True)
+    assert results['release'] == PhaseResult('release', SUCCEEDED, 'build_release',
+                                             results['release'].started,
+                                             results['release'].duration)
+
+
+def test_exiting_phase_reports_failure():
+    calls = []
+
+    def prepare():
+        exit(1)
+    runners = {'prepare': prepare, 'build': _runner(calls, 'build')}
+    results = run_phases(runners, ['build'])
+    assert results['prepare'].status == FAILED
+    assert results['build'].status == SKIPPED
+    assert calls == []
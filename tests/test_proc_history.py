@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from lain_sdk.yaml.parser import LainConf, Proc
+from lain_sdk.yaml.history import ProcHistory
+
+META_VERSION = '1428553798.443334-7142797e64bb7b4d057455ef13de6be156ae81cc'
+
+META_YAML = '''
+appname: hello
+build:
+    base: golang
+    script: [go build -o hello]
+proc.mailer: {type: worker, cmd: hello, port: 80, memory: 128m, env: [A=a]}
+'''
+
+
+def _mailer():
+    conf = LainConf()
+    conf.load(META_YAML, META_VERSION, None)
+    return conf.procs['mailer']
+
+
+def test_proc_history_patch_records_revision():
+    mailer = _mailer()
+    history = ProcHistory(mailer)
+    revision = history.patch({'cpu': 2, 'memory': '64m'})
+    assert len(history) == 2
+    assert history.latest is revision
+    assert revision.changed == set(['cpu', 'memory'])
+    assert history.latest.proc.cpu == 2
+    assert history.latest.proc.memory == '64m'
+    # 原 proc 和旧 revision 都不会被修改
+    assert mailer.memory == '128m'
+    assert history[0].proc.memory == '128m'
+
+
+def test_proc_history_shares_unchanged_fields():
+    history = ProcHistory(_mailer())
+    history.patch({'num_instances': 3, 'port': 80})
+    old, new = history[0].proc, history[1].proc
+    assert new.env is old.env
+    assert new.cmd is old.cmd
+    assert new.port is old.port
+    assert history[1].changed == set(['num_instances'])
+
+
+def test_proc_history_patch_only_simple_scale_meta():
+    history = ProcHistory(_mailer())
+    scaled = Proc()
+    scaled.load('proc.mailer', {'type': 'worker', 'cmd': 'other', 'cpu': 4,
+                                'memory': '1g', 'num_instances': 5},
+                'hello', META_VERSION, None)
+    history.patch_only_simple_scale_meta(scaled)
+    latest = history.latest.proc
+    assert (latest.cpu, latest.memory, latest.num_instances) == (4, '1g', 5)
+    assert latest.cmd == ['hello']
+
+
+def test_proc_history_diff():
+    history = ProcHistory(_mailer())
+    history.patch({'cpu': 2})
+    history.patch({'memory': '256m'})
+    history.patch({'cpu': 0})
+    assert history.diff(0, 1) == {'cpu': (0, 2)}
+    assert history.diff(0) == {'memory': ('128m', '256m')}
+    assert history.diff(3, 1) == {'cpu': (0, 2), 'memory': ('256m', '128m')}
+    assert history.diff(2, 2) == {}
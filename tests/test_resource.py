@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import mock
+from lain_sdk.yaml import resource
+from lain_sdk.yaml.resource import (ResourceInstanceCache, ResourceDependencies,
+                                    resource_instance_key)
+from lain_sdk.yaml.parser import render_resource_instance_meta, RenderPlan
+
+REDIS_RESOURCE_META = '''
+appname: redis
+apptype: resource
+
+build:
+  base: golang
+  script:
+    - go build -o hello
+
+service.redis:
+  cmd: redis -p 3333
+  port: 3333
+  memory: "{{ memory|default('64M') }}"
+  num_instances: "{{ num_instances|default(1) }}"
+  portal:
+    cmd: ./proxy
+'''
+REDIS_RESOURCE_META_VERSION = '1439365340-06e92b4456116ad5e6875c8c34797d22156d44a5'
+REGISTRY = 'registry.lain.local'
+DOMAINS = ['lain.local']
+
+
+def _render(cache, client_appname='hello', context=None, meta_version=REDIS_RESOURCE_META_VERSION):
+    return cache.render_resource_instance_meta(
+        'redis', meta_version, REDIS_RESOURCE_META,
+        client_appname, context or {}, REGISTRY, DOMAINS)
+
+
+def test_resource_instance_key_ignores_dict_order():
+    key = lambda context: resource_instance_key(
+        'redis', REDIS_RESOURCE_META_VERSION, REDIS_RESOURCE_META,
+        'hello', context, REGISTRY, DOMAINS)
+    assert key({'a': 1, 'b': 2}) == key(dict([('b', 2), ('a', 1)]))
+    assert key({'a': 1}) != key({'a': 2})
+
+
+def test_resource_instance_cache_renders_once():
+    cache = ResourceInstanceCache(maxsize=2)
+    with mock.patch.object(resource, 'render_resource_instance_meta',
+                           wraps=render_resource_instance_meta) as render:
+        first = _render(cache, context={'memory': '128M'})
+        assert _render(cache, context={'memory': '128M'}) == first
+        assert render.call_count == 1
+        _render(cache, client_appname='world')
+        _render(cache, meta_version='1439365341-06e92b4456116ad5e6875c8c34797d22156d44a5')
+        assert render.call_count == 3
+    assert first == render_resource_instance_meta(
+        'redis', REDIS_RESOURCE_META_VERSION, REDIS_RESOURCE_META,
+        'hello', {'memory': '128M'}, REGISTRY, DOMAINS)
+    assert cache.stats == {'size': 2, 'maxsize': 2, 'hits': 1, 'disk_hits': 0, 'misses': 3}
+
+
+def test_resource_instance_cache_disk_tier(tmpdir):
+    cache_dir = str(tmpdir.join('instances'))
+    first = _render(ResourceInstanceCache(cache_dir=cache_dir))
+    assert len(os.listdir(cache_dir)) == 1
+
+    cache = ResourceInstanceCache(cache_dir=cache_dir)
+    with mock.patch.object(resource, 'render_resource_instance_meta') as render:
+        assert _render(cache) == first
+        assert _render(cache) == first
+        assert not render.called
+    assert cache.stats['disk_hits'] == 1
+    assert cache.stats['hits'] == 1
+
+    cache.clear()
+    assert os.listdir(cache_dir) == []
+
+
+def _use_redis(**context):
+    return {'redis': {'services': ['redis'], 'context': context}}
+
+
+def test_resource_dependencies_only_render_affected_instances():
+    deps = ResourceDependencies()
+    deps.set_client('hello', _use_redis(memory='128M'))
+    deps.set_client('world', _use_redis())
+    deps.set_client('foo', _use_redis(unused='x'))
+    deps.set_client('bar', {'mysql': {'services': ['mysql'], 'context': {}}})
+    assert deps.clients_of('redis') == ['foo', 'hello', 'world']
+
+    # world 和 foo 在模板用到的变量上相同，只渲染一次
+    with mock.patch.object(RenderPlan, 'render', autospec=True,
+                           side_effect=RenderPlan.render) as render:
+        changed = deps.publish('redis', REDIS_RESOURCE_META_VERSION, REDIS_RESOURCE_META,
+                               REGISTRY, DOMAINS)
+        assert render.call_count == 2
+    assert [s.client_appname for s in changed] == ['foo', 'hello', 'world']
+    hello = changed[1]
+    assert hello.instance_meta == render_resource_instance_meta(
+        'redis', REDIS_RESOURCE_META_VERSION, REDIS_RESOURCE_META,
+        'hello', {'memory': '128M'}, REGISTRY, DOMAINS)
+    assert hello.instance_config.appname == 'resource.redis.hello'
+
+    assert deps.publish('redis', REDIS_RESOURCE_META_VERSION, REDIS_RESOURCE_META,
+                        REGISTRY, DOMAINS) == []
+
+    # 只改了默认内存，显式指定了内存的 hello 不受影响
+    template = REDIS_RESOURCE_META.replace("default('64M')", "default('96M')")
+    assert [c for c, _ in deps.affected('redis', REDIS_RESOURCE_META_VERSION, template,
+                                        REGISTRY, DOMAINS)] == ['foo', 'world']
+    changed = deps.publish('redis', REDIS_RESOURCE_META_VERSION, template, REGISTRY, DOMAINS)
+    assert [s.client_appname for s in changed] == ['foo', 'world']
+    assert changed[1].instance_config.procs['redis'].memory == '96M'
+
+    # 模板没变，但新版本、registry 或 domains 会改变所有实例的 meta
+    new_version = '1439365341-06e92b4456116ad5e6875c8c34797d22156d44a5'
+    assert [c for c, _ in deps.affected('redis', REDIS_RESOURCE_META_VERSION, template,
+                                        'other.registry', DOMAINS)] == ['foo', 'hello', 'world']
+    assert [c for c, _ in deps.affected('redis', REDIS_RESOURCE_META_VERSION, template,
+                                        REGISTRY, ['other.domain'])] == ['foo', 'hello', 'world']
+    changed = deps.publish('redis', new_version, template, REGISTRY, DOMAINS)
+    assert [s.client_appname for s in changed] == ['foo', 'hello', 'world']
+    assert changed[1].meta_version == new_version
+    assert deps.publish('redis', new_version, template, REGISTRY, DOMAINS) == []
+
+    deps.set_client('hello', _use_redis(memory='256M'))
+    deps.remove_client('foo')
+    changed = deps.publish('redis', new_version, template, REGISTRY, DOMAINS)
+    assert [s.client_appname for s in changed] == ['hello']
+    assert deps.clients_of('redis') == ['hello', 'world']
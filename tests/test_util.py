@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+from lain_sdk.util import run_concurrently, LazyDict
+
+
+def test_run_concurrently():
+    start = time.time()
+    assert run_concurrently(lambda: time.sleep(0.2) or 1, lambda: time.sleep(0.2) or 2) == [1, 2]
+    assert time.time() - start < 0.35
+
+    def fail():
+        raise ValueError('boom')
+    with pytest.raises(ValueError):
+        run_concurrently(lambda: 1, fail)
+
+
+def test_lazy_dict():
+    calls = []
+    d = LazyDict(a=1)
+    d.set_lazy('b', lambda: calls.append('b') or 2)
+    assert len(d) == 2 and 'b' in d and sorted(d) == ['a', 'b']
+    assert calls == []
+    assert d['b'] == 2 and d.get('b') == 2
+    assert calls == ['b'] and d.is_resolved('b')
+    d.set_lazy('c', lambda: 3)
+    d['c'] = 4
+    assert dict(d) == {'a': 1, 'b': 2, 'c': 4}
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+from StringIO import StringIO
+
+import pytest
+from lain_sdk.yaml.validator.cli import main, find_lain_yamls
+
+VALID = '''
+appname: hello
+build:
+  base: golang
+  script: [go build -o hello]
+web:
+  cmd: hello
+  memory: 64M
+'''
+
+INVALID = '''
+appname: hello
+build:
+  base: golang
+  script: [go build -o hello]
+web:
+  cmd: hello
+  memory: 64
+worker.w1:
+  cmd: hello
+  num_instances: two
+'''
+
+
+@pytest.fixture
+def apps(tmpdir):
+    tmpdir.join('a', 'lain.yaml').write(VALID, ensure=True)
+    tmpdir.join('b', 'c', 'lain.yaml').write(INVALID, ensure=True)
+    tmpdir.join('d', 'lain.yaml').write('appname: [', ensure=True)
+    tmpdir.join('.git', 'lain.yaml').write(INVALID, ensure=True)
+    return tmpdir
+
+
+def test_find_lain_yamls(apps):
+    found = find_lain_yamls([str(apps)])
+    assert [f[len(str(apps)):] for f in found] == ['/a/lain.yaml', '/b/c/lain.yaml', '/d/lain.yaml']
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_validate_directory(apps, jobs):
+    out = StringIO()
+    assert main(['-j', jobs, str(apps)], out) == 1
+    lines = out.getvalue().splitlines()
+    prefix = str(apps.join('b', 'c', 'lain.yaml'))
+    assert lines[0] == "%s: web.memory: 64 is not of type 'string'" % prefix
+    assert lines[1] == "%s: worker.w1.num_instances: 'two' is not of type 'integer'" % prefix
+    assert lines[2].startswith('%s: invalid yaml' % apps.join('d', 'lain.yaml'))
+    assert lines[3] == '3 files checked, 2 failed'
+
+
+def test_validate_json_output(apps):
+    out = StringIO()
+    assert main(['--json', str(apps.join('a'))], out) == 0
+    assert json.loads(out.getvalue()) == [
+        {'file': str(apps.join('a', 'lain.yaml')), 'valid': True, 'errors': []}]
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import glob
+import os
+import random
+
+import pytest
+import yaml
+from lain_sdk.yaml.parity import corpus_paths, generate_documents
+from lain_sdk.yaml.validator import validator, is_valid
+from lain_sdk.yaml.validator.codegen import compile_validator
+
+FIXTURE_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                 'fixtures', 'data')
+
+FUZZ_KEYS = ['appname', 'build', 'release', 'test', 'publish', 'notify', 'use_services',
+             'use_resources', 'apptype', 'web', 'web.w1', 'worker', 'worker.w-1', 'oneshot.o',
+             'proc.p', 'service.s', 'portal.p', 'web.', 'proc', 'bad key', '1abc', 'services',
+             'cmd', 'entrypoint', 'memory', 'port', 'num_instances', 'cpu', 'env', 'volumes',
+             'persistent_dirs', 'cloud_volumes', 'dirs', 'type', 'portal', 'allow_clients',
+             'base', 'script', 'prepare', 'version', 'keep', 'dest_base', 'copy', 'src', 'dest',
+             'kill_timeout', 'setup_time', 'stateful', 'backup_full', 'expire', 'slack']
+FUZZ_VALUES = [None, True, False, 0, 1, -3, 10, 60, 200, 1.5, '', 'x', 'hello', '128M', '0M',
+               'resource', 'app', 'a b', [], ['x'], [1], [None], [{'src': 'a'}], {}, {'a': 1},
+               {'src': 'a', 'dest': 'b'}, {'script': ['x']}, {'dirs': ['/data']},
+               {'/data': {'backup_full': {'expire': '1d'}}}, {'cmd': 'x'}, {'services': ['s']}]
+
+
+def load_documents():
+    paths = glob.glob(os.path.join(FIXTURE_DATA_PATH, '*.yaml'))
+    paths += [p for p in corpus_paths() if p.endswith('.yaml')]
+    docs = []
+    for path in sorted(paths):
+        with open(path) as f:
+            doc = yaml.safe_load(f)
+        if isinstance(doc, dict):
+            docs.append(doc)
+    docs += [yaml.safe_load(meta_yaml) for _, meta_yaml in generate_documents(20, seed=3)]
+    return docs
+
+
+def _containers(node):
+    yield node
+    children = node.values() if isinstance(node, dict) else node
+    for child in children:
+        if isinstance(child, (dict, list)):
+            for c in _containers(child):
+                yield c
+
+
+def mutate(doc, rng):
+    doc = copy.deepcopy(doc)
+    for _ in range(rng.randint(1, 3)):
+        node = rng.choice(list(_containers(doc)))
+        value = copy.deepcopy(rng.choice(FUZZ_VALUES))
+        if isinstance(node, dict):
+            op = rng.random()
+            if node and op < 0.4:
+                node[rng.choice(list(node))] = value
+            elif node and op < 0.6:
+                del node[rng.choice(list(node))]
+            else:
+                node[rng.choice(FUZZ_KEYS)] = value
+        elif node and rng.random() < 0.7:
+            node[rng.randrange(len(node))] = value
+        else:
+            node.append(value)
+    return doc
+
+
+def test_codegen_matches_jsonschema_on_fixtures():
+    docs = load_documents()
+    assert len(docs) > 30
+    for doc in docs:
+        assert is_valid(doc) == validator.is_valid(doc), doc
+
+
+def test_codegen_matches_jsonschema_on_fuzzed_documents():
+    rng = random.Random(0)
+    docs = load_documents()
+    decisions = {True: 0, False: 0}
+    for _ in range(600):
+        doc = mutate(rng.choice(docs), rng)
+        want = validator.is_valid(doc)
+        assert is_valid(doc) == want, doc
+        decisions[want] += 1
+    # 合法和不合法的文档都要有足够的覆盖
+    assert decisions[True] > 50 and decisions[False] > 50
+
+
+def test_codegen_follows_jsonschema_type_rules():
+    check = compile_validator({
+        'type': 'object',
+        'properties': {
+            'n': {'type': 'integer', 'minimum': 1, 'maximum': 3},
+            'p': {'pattern': '^a'},
+            'o': {'oneOf': [{'type': 'string'}, {'type': 'null'}]},
+        },
+        'patternProperties': {'^x-': {'items': {'type': 'boolean'}}},
+        'additionalProperties': False,
+        'required': ['n'],
+    })
+    assert check({'n': 2, 'p': 'abc', 'o': None, 'x-1': [True]})
+    assert check({'n': 3, 'p': 5, 'x-1': 'not a list'})
+    assert not check({'n': True})
+    assert not check({'n': 4})
+    assert not check({'n': 1, 'p': 'b'})
+    assert not check({'n': 1, 'o': 1})
+    assert not check({'n': 1, 'x-1': [1]})
+    assert not check({'n': 1, 'y': 1})
+    assert not check({})
+
+
+def test_codegen_rejects_unsupported_keywords():
+    with pytest.raises(NotImplementedError):
+        compile_validator({'type': 'array', 'uniqueItems': True})